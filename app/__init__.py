@@ -1,16 +1,17 @@
 # -*- coding: utf-8 -*-
 
-from flask import Flask
+from flask import Flask, g
 from flask_socketio import SocketIO
-from peewee import MySQLDatabase
 from celery import Celery
 
 from config import config
 from .constants import SOCKETIO_DEFAULT_NSP
+from utils.mysql_util import PooledMySQLDatabase, ReplicaSet
 
 
 socketio = SocketIO(None)
-db = MySQLDatabase(None)
+db = PooledMySQLDatabase(None)  # 主库
+db_replicas = ReplicaSet(db)  # 从库（可选），未配置时读写均使用主库
 
 
 def create_app(config_name):
@@ -23,17 +24,22 @@ def create_app(config_name):
     app.config.from_object(config[config_name])
     config[config_name].init_app(app)
     socketio.init_app(app)
-    db.init(**app.config['MYSQL'])
+    db.init(**dict(app.config['MYSQL'], **app.config['MYSQL_POOL']))
+    db_replicas.init(app.config['MYSQL_REPLICAS'], **app.config['MYSQL_POOL'])
+    db_replicas.retry_interval = app.config['MYSQL_REPLICA_RETRY_INTERVAL']
 
     from .socketio_nsp import DefaultNamespace
     socketio.on_namespace(DefaultNamespace(SOCKETIO_DEFAULT_NSP))
 
     from .models import models
     db.create_tables(models, safe=True)
+    db.close()
 
-    from .hooks import before_app_request, after_app_request
+    from .hooks import before_app_request, after_app_response, after_app_request, mark_db_written
     app.before_request(before_app_request)
+    app.after_request(after_app_response)
     app.teardown_request(after_app_request)
+    db.on_write = mark_db_written
 
     from .blueprints.www_main import bp_www_main
     from .blueprints.www_api import bp_www_api
@@ -65,6 +71,9 @@ def create_celery_app(app=None):
 
         def __call__(self, *args, **kwargs):
             with app.app_context():
+                if app.config.get('IDENTITY_MAP'):
+                    g.identity_map = {}  # 每个任务使用独立的identity map
+                g.read_replica = getattr(self, 'read_replica', False)  # @celery.task(read_replica=True)的任务查询使用从库
                 return TaskBase.__call__(self, *args, **kwargs)
 
     celery.Task = ContextTask
@@ -10,25 +10,43 @@ __all__ = [
     'get_object',
     'update_object_show',
     'update_object_weight',
+    'update_objects_show',
+    'update_objects_weight',
     'delete_object',
     'delete_objects'
 ]
 
 
-def list_objects(model, mark='objects'):
+def list_objects(model, mark='objects', count_strategy=None):
     """
-    列出全部对象
+    列出全部对象：URL参数中有after/before时使用游标分页（after为空表示第一页），否则使用page/per_page分页
     :param model:
     :param mark:
+    :param count_strategy: [str or None] 总数计算方式，默认由model决定
     :return:
     """
-    order_by, page, per_page = map(request.args.get, ('order_by', 'page', 'per_page'))
+    order_by, page, per_page, after, before = map(request.args.get, ('order_by', 'page', 'per_page', 'after', 'before'))
     order_by = order_by.split(',') if order_by else None
     claim_args_digits_string(1202, *filter(None, (page, per_page)))
 
+    if after is not None or before is not None:
+        result = model.cursor_page(None, order_by, per_page, after, before, g.fields)
+        claim_args(1202, result)
+        objects, after, before = result
+        data = {
+            mark: model.to_dicts(objects, g.fields),
+            'after': after,
+            'before': before
+        }
+        if request.args.get('count') in ('1', 'true'):
+            data['total'], data['total_exact'] = model.total(count_strategy)
+        return api_success_response(data)
+
+    total, total_exact = model.total(count_strategy)
     data = {
-        mark: [obj.to_dict(g.fields) for obj in model.iterator(None, order_by, page, per_page)],
-        'total': model.count()
+        mark: model.to_dicts(model.iterator(None, order_by, page, per_page, g.fields), g.fields),
+        'total': total,
+        'total_exact': total_exact
     }
     return api_success_response(data)
 
@@ -42,7 +60,7 @@ def get_object(model, _id=None, _uuid=None, mark='object'):
     :param mark:
     :return:
     """
-    obj = model.query_by_id(_id) or model.query_by_uuid(_uuid)
+    obj = model.query_by_id(_id, g.fields) or model.query_by_uuid(_uuid, g.fields)
     claim_args(1104, obj)
 
     data = {
@@ -61,7 +79,7 @@ def update_object_show(model, _id=None, _uuid=None, mark='object'):
     :return:
     """
     show = g.json.get('show')
-    obj = model.query_by_id(_id) or model.query_by_uuid(_uuid)
+    obj = model.query_by_id(_id) or model.query_by_uuid(_uuid)  # 需要保存的对象查询全部列（缓存键如openid不能缺失）
     claim_args(1104, obj)
     claim_args(1401, show)
     claim_args_bool(1402, show)
@@ -82,7 +100,7 @@ def update_object_weight(model, _id=None, _uuid=None, mark='object'):
     :return:
     """
     weight = g.json.get('weight')
-    obj = model.query_by_id(_id) or model.query_by_uuid(_uuid)
+    obj = model.query_by_id(_id) or model.query_by_uuid(_uuid)  # 需要保存的对象查询全部列（缓存键如openid不能缺失）
     claim_args(1104, obj)
     claim_args(1401, weight)
     claim_args_int(1402, weight)
@@ -93,6 +111,58 @@ def update_object_weight(model, _id=None, _uuid=None, mark='object'):
     return api_success_response(data)
 
 
+def _update_objects(model, name, claim_value, mark):
+    """
+    批量修改对象的同一字段：json数据中mark对应[{id或uuid, name: value}, ...]，在一个事务中修改并返回修改后的对象
+    :param model:
+    :param name: 字段名称
+    :param claim_value: 字段值的校验函数
+    :param mark:
+    :return:
+    """
+    items = g.json.get(mark)
+    claim_args(1401, items)
+    claim_args_list(1402, items)
+    claim_args_dict(1402, *items)
+    key = 'id' if all(item.get('id') is not None for item in items) else 'uuid'
+    keys, values = [item.get(key) for item in items], [item.get(name) for item in items]
+    claim_args(1401, *(keys + values))
+    claim_value(1402, *values)
+    if key == 'id':
+        claim_args_int(1402, *keys)
+        ids = model.query_ids(ids=keys)
+    else:
+        claim_args_string(1402, *keys)
+        ids = model.query_ids(uuids=keys)
+    claim_args(1104, ids)
+
+    model.bulk_update(name, dict(zip(keys, values)), key)
+    data = {
+        mark: model.to_dicts(model.query_by_ids(ids, g.fields), g.fields)
+    }
+    return api_success_response(data)
+
+
+def update_objects_show(model, mark='objects'):
+    """
+    批量修改对象是否展示
+    :param model:
+    :param mark:
+    :return:
+    """
+    return _update_objects(model, 'show', claim_args_bool, mark)
+
+
+def update_objects_weight(model, mark='objects'):
+    """
+    批量修改对象排序权重（如拖拽排序）
+    :param model:
+    :param mark:
+    :return:
+    """
+    return _update_objects(model, 'weight', claim_args_int, mark)
+
+
 def delete_object(model, _id=None, _uuid=None):
     """
     删除单个对象
@@ -119,12 +189,10 @@ def delete_objects(model):
     if ids:
         ids = ids.split(',')
         claim_args_digits_string(1602, *ids)
-        objects = map(model.query_by_id, ids)
+        ids = model.query_ids(ids=ids)
     else:
-        uuids = uuids.split(',')
-        objects = map(model.query_by_uuid, uuids)
-    claim_args(1104, *objects)
+        ids = model.query_ids(uuids=uuids.split(','))
+    claim_args(1104, ids)
 
-    for obj in objects:
-        obj.delete_instance(recursive=True)
+    model.delete_by_ids(ids)
     return api_success_response({})
@@ -6,7 +6,6 @@ from ...models import WXUser
 from ...constants import WX_USER_COOKIE_KEY
 from utils.aes_util import decrypt
 from utils.redis_util import redis_client
-from utils.weixin_util import get_user_info
 
 
 def wx_user_authentication():
@@ -30,10 +29,13 @@ def wx_user_authentication():
         return
 
     key = 'wx_user:%s:info' % g.user.openid
-    if redis_client.get(key) != 'off':
-        redis_client.set(key, 'off', ex=28800)  # 每隔八小时更新微信用户基本信息
-        info = get_user_info(current_app.config['WEIXIN'], g.user.openid)
-        if info:
-            g.user.update_wx_user(**info)
-        else:
-            current_app.logger.error(u'微信用户基本信息获取失败')
+    try:
+        if redis_client.set(key, 'off', ex=28800, nx=True):  # 每隔八小时更新微信用户基本信息（后台批量更新）
+            try:
+                from ...tasks import schedule_wx_user_info_refresh
+                schedule_wx_user_info_refresh(g.user.openid)
+            except Exception:
+                redis_client.delete(key)  # 安排失败时下次请求重新安排
+                raise
+    except Exception, e:
+        current_app.logger.error(e)  # redis或celery不可用时不影响请求
@@ -9,9 +9,9 @@ from Crypto.Cipher import AES
 import xmltodict
 
 from . import bp_www_main
-from ...models import WXUser, WXPayOrder, WXPayRefund
+from ...models import WXUser
 from ...constants import WX_USER_COOKIE_KEY, WX_USER_COOKIE_VALID_DAYS
-from ...services.weixin import query_order
+from ...services.weixin import handle_pay_notify, handle_refund_notify
 from utils.aes_util import encrypt
 from utils.redis_util import redis_client
 from utils.qiniu_util import get_upload_token
@@ -107,16 +107,16 @@ def wx_api():
             key = 'wx_user:%s:info' % openid
             if not wx_user or (msg_type == 'event' and event in ['subscribe', 'unsubscribe']):
                 redis_client.delete(key)
-            if redis_client.get(key) != 'off':
-                redis_client.set(key, 'off', ex=28800)  # 每隔八小时更新微信用户基本信息
-                info = get_user_info(current_app.config['WEIXIN'], openid)
-                if info:
-                    if wx_user:
-                        wx_user.update_wx_user(**info)
-                    else:
-                        wx_user = WXUser.create_wx_user(**info)
+            if redis_client.set(key, 'off', ex=28800, nx=True):  # 每隔八小时更新微信用户基本信息
+                if wx_user:
+                    from ...tasks import schedule_wx_user_info_refresh
+                    schedule_wx_user_info_refresh(openid)  # 已有用户合并为批量更新
                 else:
-                    current_app.logger.error(u'微信用户基本信息获取失败')
+                    info = get_user_info(current_app.config['WEIXIN'], openid)
+                    if info:
+                        wx_user = WXUser.create_wx_user(**info)
+                    else:
+                        current_app.logger.error(u'微信用户基本信息获取失败')
 
             # TODO: 微信API业务逻辑
         except Exception, e:
@@ -136,24 +136,14 @@ def wx_pay_notify():
         result = xmltodict.parse(request.data)['xml']
         sign = result.pop('sign')
         assert sign == generate_pay_sign(current_app.config['WEIXIN'], result), u'微信支付签名验证失败'
-        out_trade_no = result['out_trade_no']
+        assert result.get('out_trade_no'), u'微信支付结果通知缺少out_trade_no'
     except Exception, e:
         current_app.logger.error(e)
         current_app.logger.info(request.data)
         return make_response(template.render(return_code='FAIL', return_msg=e.message))
 
-    wx_pay_order = WXPayOrder.query_by_out_trade_no(out_trade_no)
-    if wx_pay_order and not wx_pay_order.notify_result_code:
-        if wx_pay_order.total_fee != int(result['total_fee']):
-            current_app.logger.error(u'微信支付结果通知订单金额不一致')
-            current_app.logger.info(request.data)
-        else:
-            wx_pay_order.update_notify_result(result)
-            # TODO: 微信支付业务逻辑A
-            if wx_pay_order.notify_result_code == 'SUCCESS':
-                pass
-            else:
-                current_app.logger.error(u'微信支付失败(wx_pay_order_id: %s)' % wx_pay_order.id)
+    if not _schedule_notify('pay', result):
+        handle_pay_notify(result)
     return make_response(template.render(return_code='SUCCESS'))
 
 
@@ -172,27 +162,35 @@ def wx_refund_notify():
         plain_text = cipher.decrypt(cipher_text)
         plain_text = plain_text[:-ord(plain_text[-1])]
         info = xmltodict.parse(plain_text)['root']
-        out_refund_no = info['out_refund_no']
+        assert info.get('out_refund_no'), u'微信支付退款结果通知缺少out_refund_no'
     except Exception, e:
         current_app.logger.error(e)
         current_app.logger.info(request.data)
         return make_response(template.render(return_code='FAIL', return_msg=e.message))
 
-    wx_pay_refund = WXPayRefund.query_by_out_refund_no(out_refund_no)
-    if wx_pay_refund and not wx_pay_refund.refund_status:
-        if wx_pay_refund.refund_fee != int(info['refund_fee']):
-            current_app.logger.error(u'微信支付退款结果通知退款金额不一致')
-            current_app.logger.info(request.data)
-        else:
-            wx_pay_refund.update_notify_result(info)
-            # TODO: 微信支付退款业务逻辑B
-            if wx_pay_refund.refund_status == 'SUCCESS':
-                query_order(wx_pay_refund.wx_pay_order)
-            else:
-                current_app.logger.error(u'微信支付退款失败(wx_pay_refund_id: %s)' % wx_pay_refund.id)
+    if not _schedule_notify('refund', info):
+        handle_refund_notify(info)
     return make_response(template.render(return_code='SUCCESS'))
 
 
+def _schedule_notify(kind, data):
+    """
+    异步处理模式（WX_PAY_NOTIFY_ASYNC）下将已验证的通知存入队列，由celery任务批量处理
+    :param kind: 'pay' or 'refund'
+    :param data: [dict] 通知内容
+    :return: [bool] 是否已存入队列，否则应同步处理
+    """
+    if not current_app.config['WX_PAY_NOTIFY_ASYNC']:
+        return False
+    try:
+        from ...tasks import schedule_wx_pay_notify
+        schedule_wx_pay_notify(kind, data)
+        return True
+    except Exception, e:
+        current_app.logger.error(e)  # redis或celery不可用时同步处理
+        return False
+
+
 @bp_www_main.route('/extensions/testing/wx/user/<uuid:wx_user_uuid>/login/', methods=['GET'])
 def wx_user_login_for_testing(wx_user_uuid):
     """
@@ -4,6 +4,18 @@ SOCKETIO_DEFAULT_NSP = '/socket.io.default'
 
 DEFAULT_PER_PAGE = 20
 
+COUNT_EXACT = 'exact'  # 总数计算方式：COUNT(*)
+COUNT_CACHED = 'cached'  # 总数计算方式：缓存在redis中，创建/删除对象时失效
+COUNT_ESTIMATED = 'estimated'  # 总数计算方式：MySQL统计信息中的估计行数
+COUNT_ESTIMATE_THRESHOLD = 10000  # 估计行数少于该值时仍精确计数
+
+BULK_CHUNK_SIZE = 500  # 批量操作时每条SQL语句中IN/CASE的最大对象数
+PAYLOAD_COMPRESS_THRESHOLD = 2048  # 序列化数据超过该字节数时压缩保存
+
+MODEL_CACHE_TTL = 3600
+
+DB_STICKY_COOKIE_KEY = 'db_primary'  # 写入后一段时间内查询使用主库的会话标记
+
 ADMIN_TOKEN_TAG = 'admin'
 ADMIN_TOKEN_VALID_DAYS = 7
 
@@ -11,3 +23,21 @@ MIN_PASSWORD_LEN = 6
 
 WX_USER_COOKIE_KEY = 'wx_user'
 WX_USER_COOKIE_VALID_DAYS = 30
+WX_USER_INFO_FLUSH_DELAY = 2  # 合并微信用户基本信息更新请求的时间窗口（秒）
+WX_FOLLOWER_SYNC_BATCH = 1000  # 同步微信关注者时每次批量写入的用户数
+WX_FOLLOWER_SYNC_CONCURRENCY = 10  # 同步微信关注者时并发获取基本信息的请求数
+
+WX_PAY_SWEEP_DELAY = 10  # 下单超过该时间（秒）仍未确认支付结果的订单由定时任务跟进
+WX_PAY_SWEEP_INTERVAL = 30  # 定时任务跟进同一订单的最小间隔（秒）
+WX_PAY_SWEEP_BACKOFF = 0.1  # 定时任务跟进同一订单的间隔为订单已创建时间的该比例（不小于WX_PAY_SWEEP_INTERVAL）
+WX_PAY_SWEEP_MAX_INTERVAL = 600  # 定时任务跟进同一订单的最大间隔（秒）
+WX_PAY_SWEEP_MAX_AGE = 86400  # 定时任务只跟进该时间（秒）内创建的订单
+WX_PAY_SWEEP_MAX_ORDERS = 500  # 定时任务每次最多跟进的订单数
+WX_PAY_ORDER_EXPIRE = 7200  # 超过该时间（秒）仍未支付的订单关闭（微信支付订单默认有效期为2小时）
+WX_PAY_CANCEL_MAX_ATTEMPTS = 3  # 支付失败的订单最多尝试关闭/撤销的次数
+WX_PAY_CANCEL_RETRY_DELAY = 5  # 关闭/撤销订单需要重试时第1次重试的间隔（秒），之后每次加倍
+WX_PAY_NOTIFY_FLUSH_DELAY = 1  # 合并处理微信支付结果/退款结果通知的时间窗口（秒）
+WX_PAY_NOTIFY_BATCH = 100  # 每批处理的微信支付结果/退款结果通知数
+WX_PAY_NOTIFY_MAX_ATTEMPTS = 5  # 单个通知最多处理的次数，超过后移入失败列表
+WX_PAY_NOTIFY_CONSUMERS = 4  # 同时处理通知队列的最多任务数
+WX_PAY_NOTIFY_CONSUMER_TIMEOUT = 300  # 处理通知的任务超过该时间（秒）无进展视为已中断（如worker崩溃），其正在处理的通知放回队列
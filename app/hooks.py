@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
 
-from flask import request, g, abort
+from flask import current_app, request, g, abort, has_app_context
 
-from . import db
+from . import db, db_replicas
+from .constants import DB_STICKY_COOKIE_KEY
 
 
 def before_app_request():
@@ -14,8 +15,31 @@ def before_app_request():
         abort(404)
 
     g.ip = request.environ.get('HTTP_X_FORWARDED_FOR') or request.environ.get('REMOTE_ADDR')  # g.ip
+    if current_app.config.get('IDENTITY_MAP'):
+        g.identity_map = {}  # g.identity_map
+    g.read_replica = request.method in ['GET', 'HEAD'] and not request.cookies.get(DB_STICKY_COOKIE_KEY)  # g.read_replica
     if db.is_closed():
-        db.connect()
+        db.connect()  # 从连接池取出连接
+
+
+def after_app_response(resp):
+    """
+    响应前全局钩子函数：本次请求有写入时，之后一段时间内同一会话的查询使用主库
+    :param resp:
+    :return:
+    """
+    if g.get('db_written'):
+        resp.set_cookie(DB_STICKY_COOKIE_KEY, '1', max_age=current_app.config['MYSQL_STICKY_SECONDS'], httponly=True)
+    return resp
+
+
+def mark_db_written():
+    """
+    记录当前请求/celery任务已写入主库，之后的查询使用主库
+    :return:
+    """
+    if has_app_context():
+        g.db_written = True  # g.db_written
 
 
 def after_app_request(resp):
@@ -25,4 +49,5 @@ def after_app_request(resp):
     :return:
     """
     if not db.is_closed():
-        db.close()
+        db.close()  # 将连接归还连接池
+    db_replicas.close()
@@ -1,39 +1,398 @@
 # -*- coding: utf-8 -*-
 
-from uuid import uuid1
+from uuid import uuid1, UUID
+from collections import OrderedDict
+from contextlib import contextmanager
 import datetime
 import time
+import json
+import base64
+import operator
+import zlib
+import ast
 
-from flask import current_app
+from flask import current_app, g, has_app_context
 from peewee import *
-from playhouse.shortcuts import model_to_dict
+from playhouse.shortcuts import model_to_dict, case
+from playhouse.migrate import SchemaMigrator, migrate
 from werkzeug.security import generate_password_hash, check_password_hash
 
-from . import db
-from .constants import DEFAULT_PER_PAGE, ADMIN_TOKEN_TAG, ADMIN_TOKEN_VALID_DAYS
+from . import db, db_replicas
+from .constants import DEFAULT_PER_PAGE, ADMIN_TOKEN_TAG, ADMIN_TOKEN_VALID_DAYS, MODEL_CACHE_TTL, COUNT_EXACT, COUNT_CACHED, \
+    COUNT_ESTIMATED, COUNT_ESTIMATE_THRESHOLD, BULK_CHUNK_SIZE, PAYLOAD_COMPRESS_THRESHOLD
 from utils.aes_util import encrypt, decrypt
 from utils.key_util import generate_random_key
+from utils.redis_util import redis_client
 
 
 _to_set = (lambda r: set(r) if r else set())
 _nullable_strip = (lambda s: s.strip() or None if s else None)
+_chunks = (lambda l, n=BULK_CHUNK_SIZE: (l[i:i + n] for i in range(0, len(l), n)))
 
+_CACHE_LOCK_TIMEOUT = 5  # 缓存重建锁的超时时间（秒）
+_CACHE_WAIT_INTERVAL = 0.05  # 等待其他进程重建缓存时的轮询间隔（秒）
+_CACHE_WAIT_TIMES = 10  # 等待其他进程重建缓存时的最多轮询次数
 
-class BaseModel(Model):
+
+_SERIALIZER_PLANS_MAX_SIZE = 256  # 转换为dict表示的执行计划的LRU缓存容量
+_serializer_plans = OrderedDict()  # {(model, only, exclude): (field_names, extra_attrs)}
+
+
+def _serializer_plan(model, only=None, exclude=None):
     """
-    所有model的基类
+    获取model转换为dict表示的执行计划，按(model, only, exclude)编译一次后缓存（LRU）
+    :param model:
+    :param only: [iterable or None]
+    :param exclude: [iterable or None]
+    :return: (字段名称元组, (额外属性名称, 是否为方法)元组)
+    """
+    key = (model, frozenset(only or ()), frozenset(exclude or ()))
+    plan = _serializer_plans.pop(key, None)
+    if plan is None:
+        only, exclude = key[1], key[2] | model._exclude_fields()
+        _fields = model._meta.fields
+        only_fields = {k for k in only if k in _fields}
+        extra_attrs = model._extra_attributes() - exclude
+        if only:
+            extra_attrs &= only
+        field_names = tuple(f.name for f in model._meta.declared_fields
+                            if f.name not in exclude and (not only_fields or f.name in only_fields))
+        if only and not only_fields:
+            field_names = ()
+        plan = (field_names, tuple((attr, callable(getattr(model, attr))) for attr in sorted(extra_attrs)))
+        while len(_serializer_plans) >= _SERIALIZER_PLANS_MAX_SIZE:
+            _serializer_plans.popitem(last=False)
+    _serializer_plans[key] = plan
+    return plan
+
+
+def _serialize(obj, plan):
+    """
+    按执行计划将对象转换为dict表示
+    :param obj:
+    :param plan:
+    :return:
+    """
+    field_names, extra_attrs = plan
+    _data = obj._data
+    data = {name: _data.get(name) for name in field_names}
+    for attr, is_method in extra_attrs:
+        data[attr] = getattr(obj, attr)() if is_method else getattr(obj, attr)
+    return data
+
+
+def _selected_fields(model, only=None):
+    """
+    根据需要返回的字段/属性计算查询的列：始终包含主键及额外属性所依赖的字段（如iso_create_time依赖create_time）
+    :param model:
+    :param only: [iterable or None]
+    :return: [list or None] None表示查询全部列
+    """
+    if not only:
+        return
+    names = set(only) | {'id'}
+    names |= {attr.split('_', 1)[-1] for attr in model._extra_attributes() & names}
+    return [f for f in model._meta.sorted_fields if f.name in names]
+
+
+def _encode_cursor(obj, keys):
+    """
+    将对象的排序键值编码为不透明的游标
+    :param obj:
+    :param keys: [(field, desc)]
+    :return:
+    """
+    names = [f.name for f, desc in keys]
+    values = [f.db_value(obj._data.get(f.name)) for f, desc in keys]
+    return base64.urlsafe_b64encode(json.dumps([names, values], default=str, separators=(',', ':'))).rstrip('=')
+
+
+def _decode_cursor(token, keys):
+    """
+    解码游标，排序键与当前查询不一致时抛出ValueError
+    :param token:
+    :param keys: [(field, desc)]
+    :return: 排序键值列表
+    """
+    names, values = json.loads(base64.urlsafe_b64decode(str(token) + '=' * (-len(token) % 4)))
+    if names != [f.name for f, desc in keys] or len(values) != len(keys):
+        raise ValueError('cursor does not match order_by: %s' % token)
+    return [f.python_value(v) for (f, desc), v in zip(keys, values)]
+
+
+def _keyset_condition(keys, values, backward=False):
+    """
+    游标位置之后（backward时为之前）的查询条件：(k0 > v0) OR (k0 = v0 AND k1 > v1) OR ...
+    :param keys: [(field, desc)]
+    :param values:
+    :param backward: [bool]
+    :return:
+    """
+    clauses = []
+    for i, (field, desc) in enumerate(keys):
+        clause = field < values[i] if desc != backward else field > values[i]
+        for (f, d), v in zip(keys[:i], values[:i]):
+            clause = (f == v) & clause
+        clauses.append(clause)
+    return reduce(operator.or_, clauses)
+
+
+def _read_database(database):
+    """
+    查询使用的数据库：GET请求及标记了read_replica的celery任务中，尚未写入且不在事务中时使用从库（同一请求/任务内固定），否则使用主库；
+    _read_primary()范围内（如填充缓存）始终使用主库
+    :param database: 主库
+    :return:
+    """
+    if not (db_replicas.databases and has_app_context() and g.get('read_replica')) or g.get('read_primary'):
+        return database
+    if g.get('db_written') or database.transaction_depth():
+        return database
+    replica = g.get('db_replica')
+    if replica is None:
+        replica = g.db_replica = db_replicas.get() or False  # g.db_replica
+    return replica or database
+
+
+@contextmanager
+def _read_primary():
+    """
+    该范围内的查询使用主库：填充缓存的数据不能来自复制延迟的从库，否则主库写入并清除缓存后可能重新缓存旧数据
+    :return:
+    """
+    if not has_app_context():
+        yield
+        return
+    previous = g.get('read_primary')
+    g.read_primary = True
+    try:
+        yield
+    finally:
+        g.read_primary = previous
+
+
+def _identity_map():
+    """
+    当前请求/celery任务范围内的identity map：{(model, 'id' or 'uuid', value): obj}，未启用时返回None
+    :return:
+    """
+    if has_app_context():
+        return getattr(g, 'identity_map', None)
+
+
+def _identity_key(model, attr, value):
+    try:
+        return model, attr, int(value) if attr == 'id' else UUID(str(value)).hex
+    except (TypeError, ValueError):
+        return
+
+
+def _identity_get(model, attr, value):
+    """
+    从identity map中获取已查询的对象
+    :param model:
+    :param attr: 'id' or 'uuid'
+    :param value:
+    :return:
+    """
+    identity_map = _identity_map()
+    if identity_map:
+        return identity_map.get(_identity_key(model, attr, value))
+
+
+def _identity_add(obj):
+    """
+    将查询到的对象加入identity map
+    :param obj:
+    :return:
+    """
+    identity_map = _identity_map()
+    if identity_map is not None and obj is not None:
+        model = type(obj)
+        for attr in ('id', 'uuid'):
+            key = _identity_key(model, attr, getattr(obj, attr))
+            if key:
+                identity_map[key] = obj
+
+
+def _identity_discard(obj):
+    """
+    将已删除的对象移出identity map
+    :param obj:
+    :return:
+    """
+    identity_map = _identity_map()
+    if identity_map:
+        model = type(obj)
+        identity_map.pop(_identity_key(model, 'id', obj.id), None)
+        identity_map.pop(_identity_key(model, 'uuid', obj.uuid), None)
+
+
+def _identity_discard_ids(model, ids=None):
+    """
+    将批量删除的对象移出identity map
+    :param model:
+    :param ids: [iterable or None] None表示该model的全部对象
+    :return:
+    """
+    identity_map = _identity_map()
+    if identity_map:
+        ids = set(ids) if ids is not None else None
+        for key, obj in identity_map.items():
+            if key[0] is model and (ids is None or obj.id in ids):
+                del identity_map[key]
+
+
+def _read_through(key, load, dumps, loads, ttl=MODEL_CACHE_TTL):
+    """
+    读穿缓存：缓存缺失时只由一个进程查询数据库（主库）并写入缓存，其余进程短暂等待后重新读取，避免缓存击穿
+    :param key:
+    :param load: 查询数据库的函数，返回None时不缓存
+    :param dumps: 序列化函数
+    :param loads: 反序列化函数
+    :param ttl:
+    :return:
+    """
+    cached = redis_client.get(key)
+    if cached is not None:
+        return loads(cached)
+
+    lock_key = '%s:lock' % key
+    if not redis_client.set(lock_key, 1, nx=True, ex=_CACHE_LOCK_TIMEOUT):
+        for i in range(_CACHE_WAIT_TIMES):
+            time.sleep(_CACHE_WAIT_INTERVAL)
+            cached = redis_client.get(key)
+            if cached is not None:
+                return loads(cached)
+        return load()
+
+    try:
+        with _read_primary():
+            obj = load()
+        if obj is not None:
+            redis_client.set(key, dumps(obj), ex=ttl)
+        return obj
+    finally:
+        redis_client.delete(lock_key)
+
+
+def _encode_payload(value, compress_threshold=PAYLOAD_COMPRESS_THRESHOLD):
+    """
+    序列化为紧凑的JSON，超过compress_threshold字节时zlib压缩并以'z:'+base64表示
+    :param value: [dict]
+    :param compress_threshold:
+    :return:
+    """
+    data = json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    if compress_threshold is not None and len(data) > compress_threshold:
+        return 'z:' + base64.b64encode(zlib.compress(data))
+    return data.decode('utf-8')
+
+
+def _decode_payload(value):
+    """
+    解析PayloadField的值，兼容以repr()保存的历史数据（dict或xmltodict返回的OrderedDict）
+    :param value:
+    :return: [dict]
+    """
+    if not value:
+        return {}
+    if not isinstance(value, basestring):
+        return value
+    if value.startswith('z:'):
+        return json.loads(zlib.decompress(base64.b64decode(value[2:])))
+    try:
+        return json.loads(value)
+    except ValueError:
+        if value.startswith('OrderedDict(') and value.endswith(')'):
+            return OrderedDict(ast.literal_eval(value[12:-1]))
+        return ast.literal_eval(value)
+
+
+class PayloadField(TextField):
+    """
+    序列化数据（如微信支付响应结果）：赋值为dict，保存为紧凑的JSON（较大时压缩）；
+    从数据库加载时保持原始字符串，由_decode_payload在访问时解析
+    """
+    def __init__(self, compress_threshold=PAYLOAD_COMPRESS_THRESHOLD, *args, **kwargs):
+        self.compress_threshold = compress_threshold
+        super(PayloadField, self).__init__(*args, **kwargs)
+
+    def clone_base(self, **kwargs):
+        return super(PayloadField, self).clone_base(compress_threshold=self.compress_threshold, **kwargs)
+
+    def db_value(self, value):
+        if value is None or isinstance(value, basestring):
+            return value
+        return _encode_payload(value, self.compress_threshold)
+
+
+class _TableModel(Model):
+    """
+    所有表的公共基类：主键、查询路由（从库）及为已存在的表添加新增的字段/索引
     """
     id = PrimaryKeyField()  # 主键
+
+    class Meta:
+        database = db
+        only_save_dirty = True
+
+    @classmethod
+    def select(cls, *selection):
+        query = super(_TableModel, cls).select(*selection)
+        query.database = _read_database(cls._meta.database)
+        return query
+
+    @classmethod
+    def add_missing_columns(cls):
+        """
+        为已存在的表添加新增的字段（create_tables(safe=True)不修改已存在的表）
+        :return: 添加的列名称列表
+        """
+        database = cls._meta.database
+        table = cls._meta.db_table
+        existing = {column.name for column in database.get_columns(table)}
+        migrator = SchemaMigrator.from_database(database)
+        added = []
+        for field in cls._meta.sorted_fields:
+            if field.db_column not in existing:
+                migrate(migrator.add_column(table, field.db_column, field))
+                added.append(field.db_column)
+        return added
+
+    @classmethod
+    def add_missing_indexes(cls):
+        """
+        为已存在的表添加Meta.indexes中新增的索引（create_tables(safe=True)不修改已存在的表）；
+        MySQL 5.6及以上的InnoDB表在线创建索引，不阻塞读写
+        :return: 添加的索引名称列表
+        """
+        database = cls._meta.database
+        table = cls._meta.db_table
+        existing = {index.name for index in database.get_indexes(table)}
+        migrator = SchemaMigrator.from_database(database)
+        added = []
+        for names, unique in cls._meta.indexes:
+            columns = [cls._meta.fields[name].db_column for name in names]
+            name = database.compiler().index_name(table, columns)
+            if name not in existing:
+                migrate(migrator.add_index(table, columns, unique))
+                added.append(name)
+        return added
+
+
+class BaseModel(_TableModel):
+    """
+    所有model的基类
+    """
     uuid = UUIDField(unique=True, default=uuid1)  # UUID
     create_time = DateTimeField(default=datetime.datetime.now)  # 创建时间
     update_time = DateTimeField(default=datetime.datetime.now)  # 更新时间
     show = BooleanField(default=True)  # 是否展示
     weight = IntegerField(default=0)  # 排序权重
 
-    class Meta:
-        database = db
-        only_save_dirty = True
-
     @classmethod
     def _exclude_fields(cls):
         """
@@ -51,28 +410,42 @@ class BaseModel(Model):
         return {'iso_create_time', 'iso_update_time'}
 
     @classmethod
-    def query_by_id(cls, _id):
+    def query_by_id(cls, _id, fields=None):
         """
-        根据id查询
+        根据id查询（启用identity map时，同一请求/任务内每个id只查询一次）
         :param _id:
+        :param fields: [iterable or None] 需要返回的字段/属性，只查询相应的列（部分加载的对象不加入identity map）
         :return:
         """
-        obj = None
+        obj = _identity_get(cls, 'id', _id)
+        if obj:
+            return obj
+
         try:
-            obj = cls.get(cls.id == _id)
+            columns = _selected_fields(cls, fields)
+            obj = cls.select(*(columns or ())).where(cls.id == _id).get()
+            if columns is None:
+                _identity_add(obj)
         finally:
             return obj
 
     @classmethod
-    def query_by_uuid(cls, _uuid):
+    def query_by_uuid(cls, _uuid, fields=None):
         """
-        根据uuid查询
+        根据uuid查询（启用identity map时，同一请求/任务内每个uuid只查询一次）
         :param _uuid:
+        :param fields: [iterable or None] 需要返回的字段/属性，只查询相应的列（部分加载的对象不加入identity map）
         :return:
         """
-        obj = None
+        obj = _identity_get(cls, 'uuid', _uuid)
+        if obj:
+            return obj
+
         try:
-            obj = cls.get(cls.uuid == _uuid)
+            columns = _selected_fields(cls, fields)
+            obj = cls.select(*(columns or ())).where(cls.uuid == _uuid).get()
+            if columns is None:
+                _identity_add(obj)
         finally:
             return obj
 
@@ -92,19 +465,86 @@ class BaseModel(Model):
             return cnt
 
     @classmethod
-    def iterator(cls, select_query=None, order_by=None, page=None, per_page=None):
+    def _count_strategy(cls):
+        """
+        计算全部对象总数的默认方式
+        :return: COUNT_EXACT/COUNT_CACHED/COUNT_ESTIMATED
+        """
+        return COUNT_EXACT
+
+    @classmethod
+    def _count_cache_key(cls):
+        return 'model:%s:count' % cls._meta.db_table
+
+    @classmethod
+    def invalidate_count(cls):
+        """
+        清除缓存的总数（创建/删除对象后）
+        :return:
+        """
+        try:
+            redis_client.delete(cls._count_cache_key())
+
+        except Exception, e:
+            current_app.logger.error(e)
+
+    @classmethod
+    def _estimated_count(cls):
+        """
+        MySQL统计信息中的估计行数，无法获取时返回None
+        :return:
+        """
+        database = cls._meta.database
+        if not isinstance(database, MySQLDatabase):
+            return
+        row = database.execute_sql('SELECT `TABLE_ROWS` FROM `information_schema`.`TABLES` '
+                                   'WHERE `TABLE_SCHEMA` = DATABASE() AND `TABLE_NAME` = %s',
+                                   (cls._meta.db_table,)).fetchone()
+        if row and row[0] is not None:
+            return int(row[0])
+
+    @classmethod
+    def total(cls, strategy=None):
+        """
+        全部对象的总数
+        :param strategy: [str or None] COUNT_EXACT：COUNT(*)；COUNT_CACHED：缓存在redis中，创建/删除对象时失效；
+                         COUNT_ESTIMATED：MySQL统计信息中的估计行数，少于COUNT_ESTIMATE_THRESHOLD时仍精确计数；
+                         默认为_count_strategy()
+        :return: (总数, 是否精确)
+        """
+        strategy = strategy or cls._count_strategy()
+        try:
+            if strategy == COUNT_CACHED:
+                return _read_through(cls._count_cache_key(), lambda: cls.select().count(), str, int), True
+            if strategy == COUNT_ESTIMATED:
+                cnt = cls._estimated_count()
+                if cnt is not None and cnt >= COUNT_ESTIMATE_THRESHOLD:
+                    return cnt, False
+
+        except Exception, e:
+            current_app.logger.error(e)
+
+        return cls.count(), True
+
+    @classmethod
+    def iterator(cls, select_query=None, order_by=None, page=None, per_page=None, fields=None):
         """
         根据查询条件返回迭代器
         :param select_query: [SelectQuery or None]
         :param order_by: [iterable or None]
         :param page:
         :param per_page:
+        :param fields: [iterable or None] 需要返回的字段/属性，只查询相应的列
         :return:
         """
         try:
             if select_query is None:
                 select_query = cls.select()
 
+            columns = _selected_fields(cls, fields)
+            if columns:
+                select_query = select_query.select(*columns)
+
             if order_by:
                 _fields = cls._meta.fields
                 clauses = []
@@ -128,6 +568,73 @@ class BaseModel(Model):
             current_app.logger.error(e)
             return iter([])
 
+    @classmethod
+    def _cursor_keys(cls, order_by=None):
+        """
+        游标分页的排序键：忽略可为空的字段（NULL无法比较），并以id作为最后的排序键保证顺序唯一
+        :param order_by: [iterable or None]
+        :return: [(field, desc)]
+        """
+        _fields = cls._meta.fields
+        keys = []
+        for item in order_by or ():
+            desc, attr = item.startswith('-'), item.lstrip('+-')
+            if attr in cls._exclude_fields():
+                continue
+            if attr in cls._extra_attributes():
+                attr = attr.split('_', 1)[-1]
+            field = _fields.get(attr)
+            if field is None or field.null or field.name in [f.name for f, d in keys]:
+                continue
+            keys.append((field, desc))
+            if field.name == 'id':
+                return keys
+        keys.append((cls.id, keys[-1][1] if keys else False))
+        return keys
+
+    @classmethod
+    def cursor_page(cls, select_query=None, order_by=None, per_page=None, after=None, before=None, fields=None):
+        """
+        游标（keyset）分页：根据游标中的排序键值定位，任意一页的查询开销都与第一页相同
+        :param select_query: [SelectQuery or None]
+        :param order_by: [iterable or None]
+        :param per_page:
+        :param after: [str or None] 获取该游标之后的一页
+        :param before: [str or None] 获取该游标之前的一页
+        :param fields: [iterable or None] 需要返回的字段/属性，只查询相应的列
+        :return: (对象列表, 下一页的after游标 or None, 上一页的before游标 or None)，游标无效时返回None
+        """
+        try:
+            if select_query is None:
+                select_query = cls.select()
+
+            keys = cls._cursor_keys(order_by)
+            columns = _selected_fields(cls, fields)
+            if columns:
+                names = {f.name for f in columns}
+                select_query = select_query.select(*(columns + [f for f, desc in keys if f.name not in names]))
+
+            backward = bool(before)
+            token = before or after
+            if token:
+                select_query = select_query.where(_keyset_condition(keys, _decode_cursor(token, keys), backward))
+
+            per_page = int(per_page or DEFAULT_PER_PAGE)
+            select_query = select_query.order_by(*[f.desc() if desc != backward else f.asc() for f, desc in keys])
+            objects = list(select_query.limit(per_page + 1).naive())
+            more = len(objects) > per_page
+            objects = objects[:per_page]
+            if backward:
+                objects.reverse()
+
+            has_after, has_before = (bool(token), more) if backward else (more, bool(token))
+            return (objects,
+                    _encode_cursor(objects[-1], keys) if objects and has_after else None,
+                    _encode_cursor(objects[0], keys) if objects and has_before else None)
+
+        except Exception, e:
+            current_app.logger.error(e)
+
     def to_dict(self, only=None, exclude=None, recurse=False, backrefs=False, max_depth=None):
         """
         转换为dict表示
@@ -139,6 +646,11 @@ class BaseModel(Model):
         :return:
         """
         try:
+            if not (recurse or backrefs):
+                plan = _serializer_plan(type(self), only, exclude)
+                self.load_payloads([self], self._plan_payload_kinds(plan))
+                return _serialize(self, plan)
+
             only = _to_set(only)
             exclude = _to_set(exclude) | self._exclude_fields()
 
@@ -158,35 +670,307 @@ class BaseModel(Model):
             current_app.logger.error(e)
             return {}
 
+    @classmethod
+    def to_dicts(cls, objects, only=None, exclude=None):
+        """
+        批量转换为dict表示（共用同一执行计划）
+        :param objects: [iterable]
+        :param only: [iterable or None]
+        :param exclude: [iterable or None]
+        :return:
+        """
+        try:
+            plan = _serializer_plan(cls, only, exclude)
+            objects = list(objects)
+            cls.load_payloads(objects, cls._plan_payload_kinds(plan))
+            return [_serialize(obj, plan) for obj in objects]
+
+        except Exception, e:
+            current_app.logger.error(e)
+            return []
+
+    def prepared(self):
+        """
+        从数据库加载后记录各字段的原始值
+        :return:
+        """
+        self._original = dict(self._data)
+
+    def save(self, force_insert=False, only=None):
+        """
+        持久化到数据库，并将已保存字段的当前值记为原始值；新建对象时清除缓存的总数
+        :param force_insert: [bool]
+        :param only: [iterable or None]
+        :return:
+        """
+        insert = force_insert or self._get_pk_value() is None
+        if only:
+            saved_fields = only
+        elif insert:
+            saved_fields = self._meta.sorted_fields
+        else:
+            saved_fields = self.dirty_fields
+        rows = super(BaseModel, self).save(force_insert, only)
+        if insert:
+            self.invalidate_count()
+        original = getattr(self, '_original', None)
+        if original is not None:
+            original.update((f.name, self._data.get(f.name)) for f in saved_fields)
+        return rows
+
     def modified_fields(self, exclude=None):
         """
-        与数据库中对应的数据相比，数值有变动的字段名称列表
+        与从数据库加载时相比，数值有变动的字段名称列表（在内存中比较，不查询数据库）
         :param exclude: [iterable or None]
         :return:
         """
         try:
             exclude = _to_set(exclude)
-            db_obj = self.query_by_id(self.id)
-            return filter(lambda f: getattr(self, f) != getattr(db_obj, f) and f not in exclude,
-                          self._meta.sorted_field_names)
+            original = getattr(self, '_original', None)
+            if original is None:
+                return [f for f in self._meta.sorted_field_names if f not in exclude]
+            return [f for f in self._meta.sorted_field_names
+                    if f not in exclude and self._data.get(f) != original.get(f)]
 
         except Exception, e:
             current_app.logger.error(e)
 
     def save_if_modified(self):
         """
-        如果数值有变动，修改更新时间并持久化到数据库
+        如果数值有变动，修改更新时间并只将变动的字段持久化到数据库
         :return:
         """
         try:
-            if self.modified_fields():
+            fields = self.modified_fields()
+            if fields:
                 self.update_time = datetime.datetime.now()
-                self.save()
+                self.save(only=[self._meta.fields[f] for f in fields + ['update_time']])
             return self
 
         except Exception, e:
             current_app.logger.error(e)
 
+    @classmethod
+    def query_ids(cls, ids=None, uuids=None):
+        """
+        根据id或uuid批量查询（IN查询，数量很多时分批）
+        :param ids: [iterable or None]
+        :param uuids: [iterable or None]
+        :return: [list or None] 全部存在时返回id列表，否则返回None
+        """
+        found = None
+        try:
+            if ids is not None:
+                field, values = cls.id, list({int(_id) for _id in ids})
+            else:
+                field, values = cls.uuid, list({UUID(str(_uuid)) for _uuid in uuids})
+            result = []
+            for chunk in _chunks(values):
+                result.extend(row[0] for row in cls.select(cls.id).where(field << chunk).tuples())
+            if len(result) == len(values):
+                found = result
+        finally:
+            return found
+
+    @classmethod
+    def _bulk_dependencies(cls, ids, search_nullable=False):
+        """
+        批量删除时的依赖对象（同Model.dependencies，以IN子查询表示）
+        :param ids: [list]
+        :param search_nullable: [bool]
+        :return: (查询条件, 外键)迭代器
+        """
+        stack = [(cls, cls.id << ids)]
+        seen = set()
+        while stack:
+            klass, node = stack.pop()
+            if klass in seen:
+                continue
+            seen.add(klass)
+            for fk in klass._meta.reverse_rel.values():
+                if klass is cls and fk.to_field.name == 'id':
+                    rel_node = fk << ids
+                else:
+                    rel_node = fk << klass.select(fk.to_field).where(node)
+                if not fk.null or search_nullable:
+                    stack.append((fk.model_class, rel_node))
+                yield rel_node, fk
+
+    @classmethod
+    def delete_by_ids(cls, ids, recursive=True, delete_nullable=False):
+        """
+        批量删除（DELETE ... WHERE id IN (...)），与delete_instance相同地处理依赖对象，id数量很多时分批，全部在一个事务中执行
+        :param ids: [iterable]
+        :param recursive: [bool] 是否同时处理依赖对象（删除，或将可为空的外键置为NULL）
+        :param delete_nullable: [bool]
+        :return: 删除的行数
+        """
+        ids = list(ids)
+        rows = 0
+        dependents = set()
+        with cls._meta.database.atomic():
+            for chunk in _chunks(ids):
+                if recursive:
+                    for node, fk in reversed(list(cls._bulk_dependencies(chunk, delete_nullable))):
+                        model = fk.model_class
+                        if fk.null and not delete_nullable:
+                            model.update(**{fk.name: None}).where(node).execute()
+                        else:
+                            model.delete().where(node).execute()
+                        dependents.add(model)
+                rows += cls.delete().where(cls.id << chunk).execute()
+
+        _identity_discard_ids(cls, ids)
+        cls.invalidate_count()
+        for model in dependents:
+            _identity_discard_ids(model)
+            model.invalidate_count()
+        return rows
+
+    @classmethod
+    def query_by_ids(cls, ids, fields=None):
+        """
+        根据id批量查询（IN查询，数量很多时分批）
+        :param ids: [iterable]
+        :param fields: [iterable or None] 需要返回的字段/属性，只查询相应的列
+        :return: [list] 按ids中的顺序
+        """
+        ids = list(ids)
+        objects = {}
+        for chunk in _chunks(ids):
+            for obj in cls.iterator(cls.select().where(cls.id << chunk), fields=fields):
+                objects[obj.id] = obj
+        return [objects[_id] for _id in ids if _id in objects]
+
+    @classmethod
+    def bulk_update(cls, field, values, key='id'):
+        """
+        批量修改同一字段（UPDATE ... SET field = CASE key WHEN ... END WHERE key IN (...)），数量很多时分批，全部在一个事务中执行
+        :param field: 字段名称
+        :param values: [dict] {id or uuid: value}
+        :param key: 'id' or 'uuid'
+        :return: 修改的行数
+        """
+        key_field = cls._meta.fields[key]
+        values = {key_field.db_value(k): v for k, v in values.items()}
+        rows = 0
+        with cls._meta.database.atomic():
+            for chunk in _chunks(values.keys()):
+                expression = case(key_field, [(k, values[k]) for k in chunk])
+                rows += cls.update(**{field: expression}).where(key_field << chunk).execute()
+
+        _identity_discard_ids(cls, values.keys() if key == 'id' else None)
+        return rows
+
+    @classmethod
+    def _payload_kinds(cls):
+        """
+        保存在WXPayPayload中的原始数据类别（如微信支付响应结果）
+        :return:
+        """
+        return set()
+
+    def load_payload(self, kind):
+        """
+        获取最近一次保存的原始数据，访问时才从WXPayPayload查询
+        :param kind:
+        :return: [dict]
+        """
+        payloads = self.__dict__.setdefault('_payloads', {})
+        if kind not in payloads:
+            payload = WXPayPayload.query_latest(self._meta.db_table, self.id, kind)
+            payloads[kind] = _decode_payload(payload.payload) if payload else {}
+        return payloads[kind]
+
+    @classmethod
+    def load_payloads(cls, objects, kinds=None):
+        """
+        批量获取一组对象最近一次保存的原始数据（一次IN查询），避免逐个访问dict_*属性时每个对象、每个类别各查询一次
+        :param objects: [list]
+        :param kinds: [iterable or None] 原始数据类别，None表示全部类别
+        :return:
+        """
+        kinds = cls._payload_kinds() if kinds is None else set(kinds) & cls._payload_kinds()
+        pending = {}
+        for obj in objects:
+            loaded = obj.__dict__.get('_payloads', {})
+            if obj.id is not None and any(kind not in loaded for kind in kinds):
+                pending[obj.id] = obj
+        if not pending:
+            return
+
+        payloads = WXPayPayload.query_latest_by_objects(cls._meta.db_table, pending.keys(), kinds)
+        for _id, obj in pending.items():
+            loaded = obj.__dict__.setdefault('_payloads', {})
+            for kind in kinds:
+                if kind not in loaded:
+                    payload = payloads.get((_id, kind))
+                    loaded[kind] = _decode_payload(payload.payload) if payload else {}
+
+    @classmethod
+    def _plan_payload_kinds(cls, plan):
+        """
+        执行计划中dict_*属性所需的原始数据类别
+        :param plan:
+        :return:
+        """
+        return {attr[5:] for attr, is_method in plan[1] if attr.startswith('dict_')} & cls._payload_kinds()
+
+    def add_payload(self, kind, value):
+        """
+        保存原始数据（只增不改）
+        :param kind:
+        :param value: [dict]
+        :return:
+        """
+        if value:
+            WXPayPayload.create(object_type=self._meta.db_table, object_id=self.id, kind=kind, payload=value)
+        self.__dict__.setdefault('_payloads', {})[kind] = value or {}
+
+    @classmethod
+    def migrate_payloads(cls, after_id=0, batch_size=BULK_CHUNK_SIZE):
+        """
+        将主表中历史的原始数据（repr()或JSON）移入WXPayPayload：按id分批读取，逐行在事务中插入并将原列置为NULL（仅在该列未被修改时），
+        不长时间锁表
+        :param after_id: 从该id之后开始
+        :param batch_size:
+        :return: (本批最后的id，全部完成时为None, 移动的数据条数)
+        """
+        database = cls._meta.database
+        table = cls._meta.db_table
+        columns = {c.name for c in database.get_columns(table)}
+        kinds = sorted(k for k in cls._payload_kinds() if k in columns)
+        if not kinds:
+            return None, 0
+
+        q, p = database.quote_char, database.interpolation
+        quote = (lambda name: '%s%s%s' % (q, name, q))
+        sql = 'SELECT %s FROM %s WHERE %s > %s ORDER BY %s LIMIT %s' % (
+            ', '.join(map(quote, ['id', 'update_time'] + kinds)), quote(table), quote('id'), p, quote('id'), p)
+        rows = database.execute_sql(sql, (after_id, batch_size), require_commit=False).fetchall()
+        migrated = 0
+        for row in rows:
+            for kind, value in zip(kinds, row[2:]):
+                if value is None:
+                    continue
+                with database.atomic():
+                    sql = 'UPDATE %s SET %s = NULL WHERE %s = %s AND %s = %s' % (
+                        quote(table), quote(kind), quote('id'), p, quote(kind), p)
+                    if database.execute_sql(sql, (row[0], value)).rowcount:
+                        WXPayPayload.create(object_type=table, object_id=row[0], kind=kind,
+                                            payload=_decode_payload(value), create_time=row[1])
+                        migrated += 1
+        return (rows[-1][0] if len(rows) == batch_size else None), migrated
+
+    def delete_instance(self, recursive=False, delete_nullable=False):
+        rows = super(BaseModel, self).delete_instance(recursive, delete_nullable)
+        _identity_discard(self)
+        self.invalidate_count()
+        if recursive:
+            for query, fk in self.dependencies(delete_nullable):
+                fk.model_class.invalidate_count()
+        return rows
+
     def set_show(self, show):
         """
         设置是否展示
@@ -376,18 +1160,100 @@ class WXUser(BaseModel):
     def _extra_attributes(cls):
         return BaseModel._extra_attributes() | {'iso_subscribe_time', 'array_tagid_list'}
 
+    @classmethod
+    def _count_strategy(cls):
+        return COUNT_ESTIMATED
+
+    @staticmethod
+    def _openid_cache_key(openid):
+        return 'model:wx_user:openid:%s' % openid
+
+    @staticmethod
+    def _uuid_cache_key(_uuid):
+        return 'model:wx_user:uuid:%s' % UUID(str(_uuid)).hex
+
+    @classmethod
+    def _dumps(cls, wx_user):
+        """
+        缓存的序列化：各字段的数据库值转为JSON（不使用pickle，redis中的数据被篡改时不会执行代码）
+        :param wx_user:
+        :return:
+        """
+        data = {name: field.db_value(wx_user._data.get(name)) for name, field in cls._meta.fields.items()}
+        return json.dumps(data, default=str, separators=(',', ':'))
+
+    @classmethod
+    def _loads(cls, data):
+        data = json.loads(data)
+        wx_user = cls()
+        wx_user._data = {name: field.python_value(data[name]) for name, field in cls._meta.fields.items() if name in data}
+        wx_user._prepare_instance()
+        return wx_user
+
+    @classmethod
+    def invalidate_cache(cls, *openids):
+        """
+        清除缓存（uuid与openid的对应关系不变，无需清除）
+        :param openids:
+        :return:
+        """
+        try:
+            if openids:
+                redis_client.delete(*map(cls._openid_cache_key, openids))
+
+        except Exception, e:
+            current_app.logger.error(e)
+
+    @classmethod
+    def query_by_uuid(cls, _uuid, fields=None):
+        """
+        根据uuid查询（优先读取缓存）
+        :param _uuid:
+        :param fields: 忽略，缓存中为完整记录
+        :return:
+        """
+        wx_user = _identity_get(cls, 'uuid', _uuid)
+        if wx_user:
+            return wx_user
+
+        try:
+            key = cls._uuid_cache_key(_uuid)
+            openid = redis_client.get(key)
+            if openid:
+                wx_user = cls.query_by_openid(openid)
+                _identity_add(wx_user)
+                return wx_user
+
+            with _read_primary():
+                wx_user = super(WXUser, cls).query_by_uuid(_uuid)
+            if wx_user:
+                redis_client.set(key, wx_user.openid, ex=MODEL_CACHE_TTL)
+            return wx_user
+
+        except Exception, e:
+            current_app.logger.error(e)
+            return super(WXUser, cls).query_by_uuid(_uuid)
+
     @classmethod
     def query_by_openid(cls, openid):
         """
-        根据openid查询
+        根据openid查询（优先读取缓存）
         :param openid:
         :return:
         """
-        wx_user = None
+        def load():
+            wx_user = None
+            try:
+                wx_user = cls.get(cls.openid == openid)
+            finally:
+                return wx_user
+
         try:
-            wx_user = cls.get(cls.openid == openid)
-        finally:
-            return wx_user
+            return _read_through(cls._openid_cache_key(openid), load, cls._dumps, cls._loads)
+
+        except Exception, e:
+            current_app.logger.error(e)
+            return load()
 
     @classmethod
     def create_wx_user(cls, openid, unionid=None, nickname=None, sex=None, country=None, province=None, city=None, headimgurl=None,
@@ -434,6 +1300,89 @@ class WXUser(BaseModel):
         except Exception, e:
             current_app.logger.error(e)
 
+    @classmethod
+    def upsert_wx_users(cls, infos):
+        """
+        批量创建或更新微信用户（INSERT ... ON DUPLICATE KEY UPDATE）
+        :param infos: [list] 微信用户基本信息
+        :return: 影响的行数，写入失败时返回None
+        """
+        if not infos:
+            return 0
+
+        columns = ['unionid', 'nickname', 'sex', 'country', 'province', 'city', 'headimgurl', 'subscribe_time',
+                   'language', 'remark', 'tagid_list']
+        fields = ['uuid', 'create_time', 'update_time', 'show', 'weight', 'openid', 'subscribe'] + columns
+        rows = []
+        now = datetime.datetime.now()
+        for info in infos:
+            row = {
+                'uuid': cls.uuid.db_value(uuid1()),
+                'create_time': now,
+                'update_time': now,
+                'show': True,
+                'weight': 0,
+                'subscribe': info.get('subscribe'),
+                'sex': info.get('sex'),
+                'subscribe_time': info.get('subscribe_time'),
+                'tagid_list': ','.join(map(str, info['tagid_list'])) if info.get('tagid_list') else None
+            }
+            for k in ('openid', 'unionid', 'nickname', 'country', 'province', 'city', 'headimgurl', 'language', 'remark'):
+                row[k] = _nullable_strip(info.get(k))
+            rows.append([row[f] for f in fields])
+
+        # 取消关注的用户只更新subscribe；字段值均未变动时不修改更新时间
+        unchanged = ' AND '.join('`%s` <=> VALUES(`%s`)' % (k, k) for k in columns)
+        updates = ['`update_time` = IF(`subscribe` <=> VALUES(`subscribe`) AND (NOT VALUES(`subscribe`) OR (%s)), '
+                   '`update_time`, VALUES(`update_time`))' % unchanged]
+        updates += ['`%s` = IF(VALUES(`subscribe`), VALUES(`%s`), `%s`)' % (k, k, k) for k in columns]
+        updates.append('`subscribe` = VALUES(`subscribe`)')
+        sql = 'INSERT INTO `%s` (%s) VALUES %s ON DUPLICATE KEY UPDATE %s' % (
+            cls._meta.db_table,
+            ', '.join('`%s`' % f for f in fields),
+            ', '.join(['(%s)' % ', '.join(['%s'] * len(fields))] * len(rows)),
+            ', '.join(updates)
+        )
+        try:
+            rowcount = cls._meta.database.execute_sql(sql, [v for row in rows for v in row]).rowcount
+            cls.invalidate_cache(*[row[fields.index('openid')] for row in rows])
+            cls.invalidate_count()
+            return rowcount
+
+        except Exception, e:
+            current_app.logger.error(e)
+            return None
+
+    def save(self, *args, **kwargs):
+        rows = super(WXUser, self).save(*args, **kwargs)
+        self.invalidate_cache(self.openid)
+        return rows
+
+    def delete_instance(self, *args, **kwargs):
+        rows = super(WXUser, self).delete_instance(*args, **kwargs)
+        self.invalidate_cache(self.openid)
+        return rows
+
+    @classmethod
+    def delete_by_ids(cls, ids, *args, **kwargs):
+        ids = list(ids)
+        openids = []
+        for chunk in _chunks(ids):
+            openids.extend(row[0] for row in cls.select(cls.openid).where(cls.id << chunk).tuples())
+        rows = super(WXUser, cls).delete_by_ids(ids, *args, **kwargs)
+        cls.invalidate_cache(*openids)
+        return rows
+
+    @classmethod
+    def bulk_update(cls, field, values, key='id'):
+        key_field = cls._meta.fields[key]
+        openids = []
+        for chunk in _chunks(map(key_field.db_value, values)):
+            openids.extend(row[0] for row in cls.select(cls.openid).where(key_field << chunk).tuples())
+        rows = super(WXUser, cls).bulk_update(field, values, key)
+        cls.invalidate_cache(*openids)
+        return rows
+
     def update_wx_user(self, subscribe, unionid=None, nickname=None, sex=None, country=None, province=None, city=None,
                        headimgurl=None, subscribe_time=None, language=None, remark=None, tagid_list=None, **kwargs):
         """
@@ -483,6 +1432,66 @@ class WXUser(BaseModel):
         return map(int, self.tagid_list.split(',')) if self.tagid_list else []
 
 
+class WXPayPayload(_TableModel):
+    """
+    微信支付相关的原始数据（只增不改）：下单、通知、查询等的响应结果，按(object_type, object_id, kind, create_time)查询；
+    只有追加所需的列，不使用BaseModel的uuid（唯一索引）、update_time、show及weight
+    """
+    create_time = DateTimeField(default=datetime.datetime.now)  # 创建时间
+    object_type = CharField(max_length=32)  # 所属对象的表名
+    object_id = IntegerField()  # 所属对象的id
+    kind = CharField(max_length=32)  # 数据类别，如order_result
+    payload = PayloadField()
+
+    class Meta:
+        db_table = 'wx_pay_payload'
+        indexes = (
+            (('object_type', 'object_id', 'kind', 'create_time'), False),
+        )
+
+    @classmethod
+    def query_latest(cls, object_type, object_id, kind):
+        """
+        查询最近一次保存的原始数据
+        :param object_type:
+        :param object_id:
+        :param kind:
+        :return:
+        """
+        payload = None
+        try:
+            payload = cls.select().where(cls.object_type == object_type, cls.object_id == object_id, cls.kind == kind) \
+                .order_by(cls.create_time.desc(), cls.id.desc()).get()
+        finally:
+            return payload
+
+    @classmethod
+    def query_latest_by_objects(cls, object_type, object_ids, kinds):
+        """
+        批量查询一组对象各类别最近一次保存的原始数据（IN查询，数量很多时分批），与query_latest相同按(create_time, id)取最大
+        :param object_type:
+        :param object_ids: [iterable]
+        :param kinds: [iterable]
+        :return: [dict] {(object_id, kind): payload}
+        """
+        payloads = {}
+        kinds = list(kinds)
+        if not kinds:
+            return payloads
+        for chunk in _chunks(list(object_ids)):
+            conditions = (cls.object_type == object_type, cls.object_id << chunk, cls.kind << kinds)
+            latest = cls.select(cls.object_id, cls.kind, fn.MAX(cls.create_time)).where(*conditions) \
+                .group_by(cls.object_id, cls.kind)
+            for payload in cls.select().where(Tuple(cls.object_id, cls.kind, cls.create_time) << latest, *conditions):
+                key = (payload.object_id, payload.kind)
+                if key not in payloads or payloads[key].id < payload.id:  # create_time相同时取id最大
+                    payloads[key] = payload
+        return payloads
+
+    def dict_payload(self):
+        return _decode_payload(self.payload)
+
+
 class WXPayOrder(BaseModel):
     """
     微信支付订单
@@ -521,37 +1530,48 @@ class WXPayOrder(BaseModel):
     scene_info = TextField(null=True)
     auth_code = CharField(null=True)
 
-    order_result = TextField(null=True)  # 统一下单/提交刷卡支付响应结果
+    # order_result: 统一下单/提交刷卡支付响应结果（保存在WXPayPayload）
     order_result_code = CharField(null=True)
     prepay_id = CharField(null=True)
     mweb_url = CharField(null=True)
     code_url = CharField(null=True)
     transaction_id = CharField(null=True)
 
-    notify_result = TextField(null=True)  # 支付结果通知（统一下单）
+    # notify_result: 支付结果通知（统一下单）（保存在WXPayPayload）
     notify_result_code = CharField(null=True)
 
-    query_result = TextField(null=True)  # 查询订单响应结果
+    # query_result: 查询订单响应结果（保存在WXPayPayload）
     query_result_code = CharField(null=True)
     trade_state = CharField(null=True, choices=TRADE_STATE_CHOICES)
     trade_state_desc = CharField(null=True)
 
-    cancel_result = TextField(null=True)  # 关闭/撤销订单响应结果
+    # cancel_result: 关闭/撤销订单响应结果（保存在WXPayPayload）
     cancel_result_code = CharField(null=True)
     recall = CharField(null=True)
+    cancel_attempts = IntegerField(null=True, default=0)  # 已尝试关闭/撤销订单的次数（历史数据为NULL）
+
+    PENDING_TRADE_STATES = ('USERPAYING', None, 'NOTPAY')  # 尚未确认支付结果的订单状态（按跟进优先级排列），None表示未知
 
     class Meta:
         db_table = 'wx_pay_order'
+        indexes = (
+            (('trade_state', 'create_time'), False),
+            (('order_result_code', 'notify_result_code', 'create_time'), False)
+        )
 
     @classmethod
-    def _exclude_fields(cls):
-        return BaseModel._exclude_fields() | {'order_result', 'notify_result', 'query_result', 'cancel_result'}
+    def _payload_kinds(cls):
+        return {'order_result', 'notify_result', 'query_result', 'cancel_result'}
 
     @classmethod
     def _extra_attributes(cls):
         return BaseModel._extra_attributes() | {'dict_order_result', 'dict_notify_result', 'dict_query_result',
                                                 'dict_cancel_result'}
 
+    @classmethod
+    def _count_strategy(cls):
+        return COUNT_CACHED
+
     @classmethod
     def query_by_out_trade_no(cls, out_trade_no):
         """
@@ -565,6 +1585,47 @@ class WXPayOrder(BaseModel):
         finally:
             return order
 
+    @classmethod
+    def query_by_out_trade_nos(cls, out_trade_nos):
+        """
+        根据out_trade_no批量查询（IN查询，数量很多时分批）
+        :param out_trade_nos: [iterable]
+        :return: [dict] {out_trade_no: order}
+        """
+        orders = {}
+        for chunk in _chunks(list(set(out_trade_nos))):
+            for order in cls.select().where(cls.out_trade_no << chunk):
+                orders[order.out_trade_no] = order
+        return orders
+
+    @classmethod
+    def iter_pending(cls, start_time, end_time, batch_size=BULK_CHUNK_SIZE):
+        """
+        尚未确认支付结果的订单：已下单（或提交刷卡支付），trade_state为USERPAYING/未知/NOTPAY，且未收到成功的支付结果通知；
+        按(trade_state, create_time)索引依次对各状态从新到旧以游标分页读取（用户支付中的订单优先），只查询id及create_time
+        :param start_time: create_time的下限（包含）
+        :param end_time: create_time的上限（不包含）
+        :param batch_size:
+        :return: 迭代器
+        """
+        keys = [(cls.create_time, True), (cls.id, True)]
+        for state in cls.PENDING_TRADE_STATES:
+            query = cls.select(cls.id, cls.create_time).where(
+                cls.trade_state >> None if state is None else cls.trade_state == state,
+                cls.create_time >= start_time,
+                cls.create_time < end_time,
+                (cls.order_result_code == 'SUCCESS') | (cls.trade_type == 'MICROPAY'),
+                (cls.notify_result_code >> None) | (cls.notify_result_code != 'SUCCESS')
+            ).order_by(cls.create_time.desc(), cls.id.desc()).limit(batch_size)
+            orders = list(query.naive())
+            while orders:
+                for order in orders:
+                    yield order
+                if len(orders) < batch_size:
+                    break
+                last = orders[-1]
+                orders = list(query.where(_keyset_condition(keys, [last.create_time, last.id])).naive())
+
     @classmethod
     def create_wx_pay_order(cls, body, total_fee, spbill_create_ip, trade_type, device_info=None, detail=None,
                             attach=None, fee_type=None, time_start=None, time_expire=None, goods_tag=None,
@@ -620,16 +1681,17 @@ class WXPayOrder(BaseModel):
         :return:
         """
         try:
-            self.order_result = repr(result) if result else None
-            self.order_result_code = result.get('result_code')
-            if self.order_result_code == 'SUCCESS':
-                self.prepay_id = _nullable_strip(result.get('prepay_id'))
-                self.mweb_url = _nullable_strip(result.get('mweb_url'))
-                self.code_url = _nullable_strip(result.get('code_url'))
-                self.transaction_id = _nullable_strip(result.get('transaction_id'))
-            self.update_time = datetime.datetime.now()
-            self.save()
-            return self
+            with self._meta.database.atomic():  # 原始数据与状态一起写入
+                self.add_payload('order_result', result)
+                self.order_result_code = result.get('result_code')
+                if self.order_result_code == 'SUCCESS':
+                    self.prepay_id = _nullable_strip(result.get('prepay_id'))
+                    self.mweb_url = _nullable_strip(result.get('mweb_url'))
+                    self.code_url = _nullable_strip(result.get('code_url'))
+                    self.transaction_id = _nullable_strip(result.get('transaction_id'))
+                self.update_time = datetime.datetime.now()
+                self.save()
+                return self
 
         except Exception, e:
             current_app.logger.error(e)
@@ -641,12 +1703,13 @@ class WXPayOrder(BaseModel):
         :return:
         """
         try:
-            self.notify_result = repr(result) if result else None
-            self.notify_result_code = result.get('result_code')
-            self.transaction_id = _nullable_strip(result.get('transaction_id'))
-            self.update_time = datetime.datetime.now()
-            self.save()
-            return self
+            with self._meta.database.atomic():  # 原始数据与状态一起写入
+                self.add_payload('notify_result', result)
+                self.notify_result_code = result.get('result_code')
+                self.transaction_id = _nullable_strip(result.get('transaction_id'))
+                self.update_time = datetime.datetime.now()
+                self.save()
+                return self
 
         except Exception, e:
             current_app.logger.error(e)
@@ -658,15 +1721,16 @@ class WXPayOrder(BaseModel):
         :return:
         """
         try:
-            self.query_result = repr(result) if result else None
-            self.query_result_code = result.get('result_code')
-            if self.query_result_code == 'SUCCESS':
-                self.transaction_id = _nullable_strip(result.get('transaction_id'))
-                self.trade_state = _nullable_strip(result.get('trade_state'))
-                self.trade_state_desc = _nullable_strip(result.get('trade_state_desc'))
-            self.update_time = datetime.datetime.now()
-            self.save()
-            return self
+            with self._meta.database.atomic():  # 原始数据与状态一起写入
+                self.add_payload('query_result', result)
+                self.query_result_code = result.get('result_code')
+                if self.query_result_code == 'SUCCESS':
+                    self.transaction_id = _nullable_strip(result.get('transaction_id'))
+                    self.trade_state = _nullable_strip(result.get('trade_state'))
+                    self.trade_state_desc = _nullable_strip(result.get('trade_state_desc'))
+                self.update_time = datetime.datetime.now()
+                self.save()
+                return self
 
         except Exception, e:
             current_app.logger.error(e)
@@ -678,27 +1742,49 @@ class WXPayOrder(BaseModel):
         :return:
         """
         try:
-            self.cancel_result = repr(result) if result else None
-            self.cancel_result_code = result.get('result_code')
-            self.recall = _nullable_strip(result.get('recall'))
-            self.update_time = datetime.datetime.now()
-            self.save()
-            return self
+            with self._meta.database.atomic():  # 原始数据与状态一起写入
+                self.add_payload('cancel_result', result)
+                self.cancel_result_code = result.get('result_code')
+                self.recall = _nullable_strip(result.get('recall'))
+                self.update_time = datetime.datetime.now()
+                self.save()
+                return self
 
         except Exception, e:
             current_app.logger.error(e)
 
+    def increase_cancel_attempts(self):
+        """
+        记录一次关闭/撤销订单的尝试（比较并交换：并发或重复执行的任务中只有一个成功）
+        :return: [bool] 是否成功
+        """
+        try:
+            cls = type(self)
+            attempts = self.cancel_attempts or 0
+            attempts_expr = fn.COALESCE(cls.cancel_attempts, 0)
+            rows = cls.update(cancel_attempts=attempts_expr + 1).where(cls.id == self.id, attempts_expr == attempts).execute()
+            if not rows:
+                return False
+            self._data['cancel_attempts'] = attempts + 1
+            if getattr(self, '_original', None) is not None:
+                self._original['cancel_attempts'] = attempts + 1
+            return True
+
+        except Exception, e:
+            current_app.logger.error(e)
+            return False
+
     def dict_order_result(self):
-        return eval(self.order_result) if self.order_result else {}
+        return self.load_payload('order_result')
 
     def dict_notify_result(self):
-        return eval(self.notify_result) if self.notify_result else {}
+        return self.load_payload('notify_result')
 
     def dict_query_result(self):
-        return eval(self.query_result) if self.query_result else {}
+        return self.load_payload('query_result')
 
     def dict_cancel_result(self):
-        return eval(self.cancel_result) if self.cancel_result else {}
+        return self.load_payload('cancel_result')
 
 
 class WXPayRefund(BaseModel):
@@ -718,27 +1804,31 @@ class WXPayRefund(BaseModel):
     refund_desc = CharField(null=True)
     refund_account = CharField(null=True)
 
-    refund_result = TextField(null=True)  # 申请退款响应结果
+    # refund_result: 申请退款响应结果（保存在WXPayPayload）
     refund_result_code = CharField(null=True)
     refund_id = CharField(null=True)
 
-    notify_result = TextField(null=True)  # 退款结果通知
+    # notify_result: 退款结果通知（保存在WXPayPayload）
     refund_status = CharField(null=True, choices=REFUND_STATUS_CHOICES)
 
-    query_result = TextField(null=True)  # 查询退款响应结果
+    # query_result: 查询退款响应结果（保存在WXPayPayload）
     query_result_code = CharField(null=True)
 
     class Meta:
         db_table = 'wx_pay_refund'
 
     @classmethod
-    def _exclude_fields(cls):
-        return BaseModel._exclude_fields() | {'refund_result', 'notify_result', 'query_result'}
+    def _payload_kinds(cls):
+        return {'refund_result', 'notify_result', 'query_result'}
 
     @classmethod
     def _extra_attributes(cls):
         return BaseModel._extra_attributes() | {'dict_refund_result', 'dict_notify_result', 'dict_query_result'}
 
+    @classmethod
+    def _count_strategy(cls):
+        return COUNT_CACHED
+
     @classmethod
     def query_by_out_refund_no(cls, out_refund_no):
         """
@@ -752,6 +1842,19 @@ class WXPayRefund(BaseModel):
         finally:
             return refund
 
+    @classmethod
+    def query_by_out_refund_nos(cls, out_refund_nos):
+        """
+        根据out_refund_no批量查询（IN查询，数量很多时分批）
+        :param out_refund_nos: [iterable]
+        :return: [dict] {out_refund_no: refund}
+        """
+        refunds = {}
+        for chunk in _chunks(list(set(out_refund_nos))):
+            for refund in cls.select().where(cls.out_refund_no << chunk):
+                refunds[refund.out_refund_no] = refund
+        return refunds
+
     @classmethod
     def create_wx_pay_refund(cls, wx_pay_order, refund_fee, refund_fee_type=None, refund_desc=None, refund_account=None):
         """
@@ -783,12 +1886,13 @@ class WXPayRefund(BaseModel):
         :return:
         """
         try:
-            self.refund_result = repr(result) if result else None
-            self.refund_result_code = result.get('result_code')
-            self.refund_id = _nullable_strip(result.get('refund_id'))
-            self.update_time = datetime.datetime.now()
-            self.save()
-            return self
+            with self._meta.database.atomic():  # 原始数据与状态一起写入
+                self.add_payload('refund_result', result)
+                self.refund_result_code = result.get('result_code')
+                self.refund_id = _nullable_strip(result.get('refund_id'))
+                self.update_time = datetime.datetime.now()
+                self.save()
+                return self
 
         except Exception, e:
             current_app.logger.error(e)
@@ -800,11 +1904,12 @@ class WXPayRefund(BaseModel):
         :return:
         """
         try:
-            self.notify_result = repr(result) if result else None
-            self.refund_status = _nullable_strip(result.get('refund_status'))
-            self.update_time = datetime.datetime.now()
-            self.save()
-            return self
+            with self._meta.database.atomic():  # 原始数据与状态一起写入
+                self.add_payload('notify_result', result)
+                self.refund_status = _nullable_strip(result.get('refund_status'))
+                self.update_time = datetime.datetime.now()
+                self.save()
+                return self
 
         except Exception, e:
             current_app.logger.error(e)
@@ -816,25 +1921,26 @@ class WXPayRefund(BaseModel):
         :return:
         """
         try:
-            index = result.keys()[result.values().index(self.out_refund_no)].split('_')[-1]
-            self.query_result = repr(result) if result else None
-            self.query_result_code = result.get('result_code')
-            self.refund_status = _nullable_strip(result.get('refund_status_%s' % index))
-            self.update_time = datetime.datetime.now()
-            self.save()
-            return self
+            with self._meta.database.atomic():  # 原始数据与状态一起写入
+                index = result.keys()[result.values().index(self.out_refund_no)].split('_')[-1]
+                self.add_payload('query_result', result)
+                self.query_result_code = result.get('result_code')
+                self.refund_status = _nullable_strip(result.get('refund_status_%s' % index))
+                self.update_time = datetime.datetime.now()
+                self.save()
+                return self
 
         except Exception, e:
             current_app.logger.error(e)
 
     def dict_refund_result(self):
-        return eval(self.refund_result) if self.refund_result else {}
+        return self.load_payload('refund_result')
 
     def dict_notify_result(self):
-        return eval(self.notify_result) if self.notify_result else {}
+        return self.load_payload('notify_result')
 
     def dict_query_result(self):
-        return eval(self.query_result) if self.query_result else {}
+        return self.load_payload('query_result')
 
 
 class WXMchPay(BaseModel):
@@ -859,11 +1965,11 @@ class WXMchPay(BaseModel):
     device_info = CharField(null=True)
     re_user_name = CharField(null=True)
 
-    pay_result = TextField(null=True)  # 企业付款响应结果
+    # pay_result: 企业付款响应结果（保存在WXPayPayload）
     pay_result_code = CharField(null=True)
     payment_no = CharField(null=True)
 
-    query_result = TextField(null=True)  # 查询企业付款响应结果
+    # query_result: 查询企业付款响应结果（保存在WXPayPayload）
     query_result_code = CharField(null=True)
     status = CharField(null=True, choices=STATUS_CHOICES)
     reason = CharField(null=True)
@@ -872,13 +1978,17 @@ class WXMchPay(BaseModel):
         db_table = 'wx_mch_pay'
 
     @classmethod
-    def _exclude_fields(cls):
-        return BaseModel._exclude_fields() | {'pay_result', 'query_result'}
+    def _payload_kinds(cls):
+        return {'pay_result', 'query_result'}
 
     @classmethod
     def _extra_attributes(cls):
         return BaseModel._extra_attributes() | {'dict_pay_result', 'dict_query_result'}
 
+    @classmethod
+    def _count_strategy(cls):
+        return COUNT_CACHED
+
     @classmethod
     def query_by_partner_trade_no(cls, partner_trade_no):
         """
@@ -927,13 +2037,14 @@ class WXMchPay(BaseModel):
         :return:
         """
         try:
-            self.pay_result = repr(result) if result else None
-            self.pay_result_code = result.get('result_code')
-            if self.pay_result_code == 'SUCCESS':
-                self.payment_no = _nullable_strip(result.get('payment_no'))
-            self.update_time = datetime.datetime.now()
-            self.save()
-            return self
+            with self._meta.database.atomic():  # 原始数据与状态一起写入
+                self.add_payload('pay_result', result)
+                self.pay_result_code = result.get('result_code')
+                if self.pay_result_code == 'SUCCESS':
+                    self.payment_no = _nullable_strip(result.get('payment_no'))
+                self.update_time = datetime.datetime.now()
+                self.save()
+                return self
 
         except Exception, e:
             current_app.logger.error(e)
@@ -945,24 +2056,25 @@ class WXMchPay(BaseModel):
         :return:
         """
         try:
-            self.query_result = repr(result) if result else None
-            self.query_result_code = result.get('result_code')
-            if self.query_result_code == 'SUCCESS':
-                self.payment_no = _nullable_strip(result.get('detail_id'))
-                self.status = _nullable_strip(result.get('status'))
-                self.reason = _nullable_strip(result.get('reason'))
-            self.update_time = datetime.datetime.now()
-            self.save()
-            return self
+            with self._meta.database.atomic():  # 原始数据与状态一起写入
+                self.add_payload('query_result', result)
+                self.query_result_code = result.get('result_code')
+                if self.query_result_code == 'SUCCESS':
+                    self.payment_no = _nullable_strip(result.get('detail_id'))
+                    self.status = _nullable_strip(result.get('status'))
+                    self.reason = _nullable_strip(result.get('reason'))
+                self.update_time = datetime.datetime.now()
+                self.save()
+                return self
 
         except Exception, e:
             current_app.logger.error(e)
 
     def dict_pay_result(self):
-        return eval(self.pay_result) if self.pay_result else {}
+        return self.load_payload('pay_result')
 
     def dict_query_result(self):
-        return eval(self.query_result) if self.query_result else {}
+        return self.load_payload('query_result')
 
 
 class WXRedPack(BaseModel):
@@ -1004,11 +2116,11 @@ class WXRedPack(BaseModel):
     risk_info = CharField(null=True)
     consume_mch_id = CharField(null=True)
 
-    send_result = TextField(null=True)  # 发放红包响应结果
+    # send_result: 发放红包响应结果（保存在WXPayPayload）
     send_result_code = CharField(null=True)
     send_listid = CharField(null=True)
 
-    query_result = TextField(null=True)  # 查询红包记录响应结果
+    # query_result: 查询红包记录响应结果（保存在WXPayPayload）
     query_result_code = CharField(null=True)
     status = CharField(null=True, choices=STATUS_CHOICES)
     reason = CharField(null=True)
@@ -1017,13 +2129,17 @@ class WXRedPack(BaseModel):
         db_table = 'wx_red_pack'
 
     @classmethod
-    def _exclude_fields(cls):
-        return BaseModel._exclude_fields() | {'send_result', 'query_result'}
+    def _payload_kinds(cls):
+        return {'send_result', 'query_result'}
 
     @classmethod
     def _extra_attributes(cls):
         return BaseModel._extra_attributes() | {'dict_send_result', 'dict_query_result'}
 
+    @classmethod
+    def _count_strategy(cls):
+        return COUNT_CACHED
+
     @classmethod
     def query_by_mch_billno(cls, mch_billno):
         """
@@ -1083,13 +2199,14 @@ class WXRedPack(BaseModel):
         :return:
         """
         try:
-            self.send_result = repr(result) if result else None
-            self.send_result_code = result.get('result_code')
-            if self.send_result_code == 'SUCCESS':
-                self.send_listid = _nullable_strip(result.get('send_listid'))
-            self.update_time = datetime.datetime.now()
-            self.save()
-            return self
+            with self._meta.database.atomic():  # 原始数据与状态一起写入
+                self.add_payload('send_result', result)
+                self.send_result_code = result.get('result_code')
+                if self.send_result_code == 'SUCCESS':
+                    self.send_listid = _nullable_strip(result.get('send_listid'))
+                self.update_time = datetime.datetime.now()
+                self.save()
+                return self
 
         except Exception, e:
             current_app.logger.error(e)
@@ -1101,24 +2218,25 @@ class WXRedPack(BaseModel):
         :return:
         """
         try:
-            self.query_result = repr(result) if result else None
-            self.query_result_code = result.get('result_code')
-            if self.query_result_code == 'SUCCESS':
-                self.send_listid = _nullable_strip(result.get('detail_id'))
-                self.status = _nullable_strip(result.get('status'))
-                self.reason = _nullable_strip(result.get('reason'))
-            self.update_time = datetime.datetime.now()
-            self.save()
-            return self
+            with self._meta.database.atomic():  # 原始数据与状态一起写入
+                self.add_payload('query_result', result)
+                self.query_result_code = result.get('result_code')
+                if self.query_result_code == 'SUCCESS':
+                    self.send_listid = _nullable_strip(result.get('detail_id'))
+                    self.status = _nullable_strip(result.get('status'))
+                    self.reason = _nullable_strip(result.get('reason'))
+                self.update_time = datetime.datetime.now()
+                self.save()
+                return self
 
         except Exception, e:
             current_app.logger.error(e)
 
     def dict_send_result(self):
-        return eval(self.send_result) if self.send_result else {}
+        return self.load_payload('send_result')
 
     def dict_query_result(self):
-        return eval(self.query_result) if self.query_result else {}
+        return self.load_payload('query_result')
 
 
-models = [Admin, WXUser, WXPayOrder, WXPayRefund, WXMchPay, WXRedPack]
+models = [Admin, WXUser, WXPayPayload, WXPayOrder, WXPayRefund, WXMchPay, WXRedPack]
@@ -1,19 +1,32 @@
 # -*- coding: utf-8 -*-
 
 import time
+import datetime
+import json
+from multiprocessing.pool import ThreadPool
 
 from flask import current_app, url_for
-import requests
 import xmltodict
 
+from ..models import WXUser, WXPayOrder, WXPayRefund
+from ..constants import WX_FOLLOWER_SYNC_BATCH, WX_FOLLOWER_SYNC_CONCURRENCY, WX_PAY_ORDER_EXPIRE, \
+    WX_PAY_CANCEL_MAX_ATTEMPTS, WX_PAY_CANCEL_RETRY_DELAY, WX_PAY_NOTIFY_BATCH, WX_PAY_NOTIFY_MAX_ATTEMPTS, \
+    WX_PAY_NOTIFY_CONSUMER_TIMEOUT
+from utils import http_util
 from utils.key_util import generate_random_key
-from utils.weixin_util import VERIFY, generate_pay_sign
+from utils.redis_util import redis_client
+from utils.weixin_util import VERIFY, generate_pay_sign, get_followers, get_user_info_batch
 
 
 _HEADERS = {
     'Content-Type': 'application/xml; charset="utf-8"'
 }
 
+_PAY_NOTIFY_PENDING_KEY = 'wx_pay:notify:pending'  # 待处理的微信支付结果/退款结果通知列表
+_PAY_NOTIFY_PROCESSING_KEY = 'wx_pay:notify:processing:%s'  # 各消费者正在处理的通知列表
+_PAY_NOTIFY_CONSUMERS_KEY = 'wx_pay:notify:consumers'  # 各消费者最近一次进展的时间（有序集合）
+_PAY_NOTIFY_FAILED_KEY = 'wx_pay:notify:failed'  # 多次处理失败的通知列表
+
 
 def place_order(order):
     """
@@ -42,7 +55,7 @@ def place_order(order):
     params['nonce_str'] = generate_random_key(16)
     params['sign'] = generate_pay_sign(wx, params)
     xml = current_app.jinja_env.get_template(template).render(**params)
-    resp = requests.post(wx_url, data=xml.encode('utf-8'), headers=_HEADERS, verify=VERIFY)
+    resp = http_util.post(wx_url, data=xml.encode('utf-8'), headers=_HEADERS, verify=VERIFY)
     resp.encoding = 'utf-8'
     try:
         result = xmltodict.parse(resp.text)['xml']
@@ -71,7 +84,7 @@ def query_order(order):
     }
     params['sign'] = generate_pay_sign(wx, params)
     xml = current_app.jinja_env.get_template(template).render(**params)
-    resp = requests.post(wx_url, data=xml.encode('utf-8'), headers=_HEADERS, verify=VERIFY)
+    resp = http_util.post(wx_url, data=xml.encode('utf-8'), headers=_HEADERS, verify=VERIFY)
     resp.encoding = 'utf-8'
     try:
         result = xmltodict.parse(resp.text)['xml']
@@ -106,7 +119,7 @@ def cancel_order(order):
     }
     params['sign'] = generate_pay_sign(wx, params)
     xml = current_app.jinja_env.get_template(template).render(**params)
-    resp = requests.post(wx_url, data=xml.encode('utf-8'), headers=_HEADERS, verify=VERIFY, cert=cert)
+    resp = http_util.post(wx_url, data=xml.encode('utf-8'), headers=_HEADERS, verify=VERIFY, cert=cert)
     resp.encoding = 'utf-8'
     try:
         result = xmltodict.parse(resp.text)['xml']
@@ -127,17 +140,213 @@ def update_order_state(order):
     query_order(order)
     status = order.trade_state
     if status == 'PAYERROR':
-        for n in range(0, 3):  # 最多尝试3次撤销订单
-            cancel_order(order)
-            if order.recall == 'Y':
-                time.sleep(5)  # 重试时间间隔为5秒钟
-            else:
-                break
+        reverse_order(order)
+    # TODO: 微信支付业务逻辑A'
+
+
+def reverse_order(order):
+    """
+    关闭/撤销支付失败的订单：需要重试（recall为Y）或请求失败时由celery任务按指数退避重试，最多WX_PAY_CANCEL_MAX_ATTEMPTS次；
+    尝试次数保存在订单中，重复或并发执行时每次尝试只执行一次
+    :param order:
+    :return:
+    """
+    if order.trade_state != 'PAYERROR':
+        return
+    if order.cancel_result_code == 'SUCCESS' and order.recall != 'Y':
+        query_order(order)
+        return
+    if (order.cancel_attempts or 0) >= WX_PAY_CANCEL_MAX_ATTEMPTS:
+        current_app.logger.error(u'微信支付关闭/撤销订单失败')
+        return
+    if not order.increase_cancel_attempts():
+        return
+
+    try:
+        cancel_order(order)
+        retry = order.recall == 'Y'
+    except Exception, e:  # 网络错误、超时等
+        current_app.logger.error(e)
+        retry = True
+    if retry:
+        if order.cancel_attempts < WX_PAY_CANCEL_MAX_ATTEMPTS:
+            from ..tasks import reverse_wx_pay_order
+            countdown = WX_PAY_CANCEL_RETRY_DELAY * 2 ** (order.cancel_attempts - 1)
+            reverse_wx_pay_order.apply_async((order.id,), countdown=countdown)
+        else:
+            current_app.logger.error(u'微信支付关闭/撤销订单失败')
+    elif order.cancel_result_code == 'SUCCESS':
+        query_order(order)
+    else:
+        current_app.logger.error(u'微信支付关闭/撤销订单失败')
+
+
+def settle_order(order):
+    """
+    跟进尚未确认支付结果的微信支付订单：查询并更新状态，超过有效期仍未支付的订单关闭
+    :param order:
+    :return:
+    """
+    if order.trade_state not in WXPayOrder.PENDING_TRADE_STATES or order.notify_result_code == 'SUCCESS':
+        return
+
+    update_order_state(order)
+    expired = order.create_time < datetime.datetime.now() - datetime.timedelta(seconds=WX_PAY_ORDER_EXPIRE)
+    if order.trade_state == 'NOTPAY' and expired:
+        cancel_order(order)
         if order.cancel_result_code == 'SUCCESS':
             query_order(order)
+
+
+def handle_pay_notify(result, order=None):
+    """
+    处理（已验证签名的）微信支付结果通知：重复的通知不再处理
+    :param result: [dict] 通知内容
+    :param order: 已查询的订单，为None时根据out_trade_no查询
+    :return:
+    """
+    order = order or WXPayOrder.query_by_out_trade_no(result['out_trade_no'])
+    if order and not order.notify_result_code:
+        if order.total_fee != int(result['total_fee']):
+            current_app.logger.error(u'微信支付结果通知订单金额不一致')
+            current_app.logger.info(result)
         else:
-            current_app.logger.error(u'微信支付关闭/撤销订单失败')
-    # TODO: 微信支付业务逻辑A'
+            order.update_notify_result(result)
+            # TODO: 微信支付业务逻辑A
+            if order.notify_result_code == 'SUCCESS':
+                pass
+            else:
+                current_app.logger.error(u'微信支付失败(wx_pay_order_id: %s)' % order.id)
+
+
+def handle_refund_notify(info, refund=None):
+    """
+    处理（已解密的）微信支付退款结果通知：重复的通知不再处理
+    :param info: [dict] 解密后的通知内容
+    :param refund: 已查询的退款，为None时根据out_refund_no查询
+    :return:
+    """
+    refund = refund or WXPayRefund.query_by_out_refund_no(info['out_refund_no'])
+    if refund and not refund.refund_status:
+        if refund.refund_fee != int(info['refund_fee']):
+            current_app.logger.error(u'微信支付退款结果通知退款金额不一致')
+            current_app.logger.info(info)
+        else:
+            refund.update_notify_result(info)
+            # TODO: 微信支付退款业务逻辑B
+            if refund.refund_status == 'SUCCESS':
+                query_order(refund.wx_pay_order)
+            else:
+                current_app.logger.error(u'微信支付退款失败(wx_pay_refund_id: %s)' % refund.id)
+
+
+def enqueue_pay_notify(kind, data):
+    """
+    将（已验证签名/解密的）微信支付结果/退款结果通知存入redis队列
+    :param kind: 'pay' or 'refund'
+    :param data: [dict] 通知内容
+    :return:
+    """
+    redis_client.lpush(_PAY_NOTIFY_PENDING_KEY, json.dumps([kind, data, 0]))
+
+
+def count_pending_pay_notifies():
+    """
+    队列中待处理的通知数
+    :return:
+    """
+    return redis_client.llen(_PAY_NOTIFY_PENDING_KEY)
+
+
+def _requeue_pay_notifies(consumer):
+    """
+    将消费者正在处理的通知放回队列
+    :param consumer:
+    :return:
+    """
+    processing_key = _PAY_NOTIFY_PROCESSING_KEY % consumer
+    while redis_client.rpoplpush(processing_key, _PAY_NOTIFY_PENDING_KEY) is not None:
+        pass
+    redis_client.zrem(_PAY_NOTIFY_CONSUMERS_KEY, consumer)
+
+
+def _handle_pay_notifies(consumer, items):
+    """
+    处理消费者取出的一批通知：订单及退款按批查询（查询失败时抛出异常），每个通知处理后从处理中列表按值移除
+    :param consumer:
+    :param items: [list] 队列中的通知，[kind, data, 已失败次数]
+    :return:
+    """
+    processing_key = _PAY_NOTIFY_PROCESSING_KEY % consumer
+    notifies = [json.loads(item) for item in items]
+    orders = WXPayOrder.query_by_out_trade_nos(data['out_trade_no'] for kind, data, n in notifies if kind == 'pay')
+    refunds = WXPayRefund.query_by_out_refund_nos(data['out_refund_no'] for kind, data, n in notifies if kind == 'refund')
+    for item, (kind, data, n) in zip(items, notifies):
+        pipe = redis_client.pipeline()
+        try:
+            if kind == 'pay':
+                order = orders.get(data['out_trade_no'])
+                if order:
+                    handle_pay_notify(data, order)
+            else:
+                refund = refunds.get(data['out_refund_no'])
+                if refund:
+                    handle_refund_notify(data, refund)
+        except Exception, e:
+            current_app.logger.error(e)
+            retry = json.dumps([kind, data, n + 1])
+            if n + 1 < WX_PAY_NOTIFY_MAX_ATTEMPTS:
+                pipe.lpush(_PAY_NOTIFY_PENDING_KEY, retry)
+            else:
+                current_app.logger.error(u'微信支付结果/退款结果通知处理失败')
+                current_app.logger.info(retry)
+                pipe.lpush(_PAY_NOTIFY_FAILED_KEY, retry)
+        pipe.lrem(processing_key, 1, item)
+        pipe.zadd(_PAY_NOTIFY_CONSUMERS_KEY, time.time(), consumer)
+        pipe.execute()
+
+
+def drain_pay_notifies(consumer, batch_size=WX_PAY_NOTIFY_BATCH):
+    """
+    作为消费者处理队列中的微信支付结果/退款结果通知，直到队列为空（可有多个消费者并发处理）：
+    逐个将通知移入自己的处理中列表（RPOPLPUSH），处理后按值移除（LREM），中断时未处理的通知不会丢失；
+    查询数据库失败时放回队列并抛出异常，消费者崩溃时由recover_pay_notifies放回队列；
+    单个通知处理失败时放回队列，失败WX_PAY_NOTIFY_MAX_ATTEMPTS次后移入失败列表
+    :param consumer: 消费者标识（如celery任务id）
+    :param batch_size: 每批取出的通知数
+    :return: 处理的通知数
+    """
+    processing_key = _PAY_NOTIFY_PROCESSING_KEY % consumer
+    count = 0
+    try:
+        while True:
+            redis_client.zadd(_PAY_NOTIFY_CONSUMERS_KEY, time.time(), consumer)
+            items = []
+            while len(items) < batch_size:
+                item = redis_client.rpoplpush(_PAY_NOTIFY_PENDING_KEY, processing_key)
+                if item is None:
+                    break
+                items.append(item)
+            if not items:
+                break
+            _handle_pay_notifies(consumer, items)
+            count += len(items)
+    except Exception:
+        _requeue_pay_notifies(consumer)
+        raise
+    redis_client.zrem(_PAY_NOTIFY_CONSUMERS_KEY, consumer)
+    return count
+
+
+def recover_pay_notifies():
+    """
+    将超过WX_PAY_NOTIFY_CONSUMER_TIMEOUT无进展（如worker崩溃）的消费者正在处理的通知放回队列
+    :return: 中断的消费者数
+    """
+    consumers = redis_client.zrangebyscore(_PAY_NOTIFY_CONSUMERS_KEY, 0, time.time() - WX_PAY_NOTIFY_CONSUMER_TIMEOUT)
+    for consumer in consumers:
+        _requeue_pay_notifies(consumer)
+    return len(consumers)
 
 
 def apply_for_refund(refund):
@@ -161,7 +370,7 @@ def apply_for_refund(refund):
     params['sign'] = generate_pay_sign(wx, params)
     xml = current_app.jinja_env.get_template(template).render(**params)
     cert = (wx['cert_path'], wx['key_path'])
-    resp = requests.post(wx_url, data=xml.encode('utf-8'), headers=_HEADERS, verify=VERIFY, cert=cert)
+    resp = http_util.post(wx_url, data=xml.encode('utf-8'), headers=_HEADERS, verify=VERIFY, cert=cert)
     resp.encoding = 'utf-8'
     try:
         result = xmltodict.parse(resp.text)['xml']
@@ -190,7 +399,7 @@ def query_refund(refund):
     }
     params['sign'] = generate_pay_sign(wx, params)
     xml = current_app.jinja_env.get_template(template).render(**params)
-    resp = requests.post(wx_url, data=xml.encode('utf-8'), headers=_HEADERS, verify=VERIFY)
+    resp = http_util.post(wx_url, data=xml.encode('utf-8'), headers=_HEADERS, verify=VERIFY)
     resp.encoding = 'utf-8'
     try:
         result = xmltodict.parse(resp.text)['xml']
@@ -239,7 +448,7 @@ def apply_for_mch_pay(pay):
     params['sign'] = generate_pay_sign(wx, params)
     xml = current_app.jinja_env.get_template(template).render(**params)
     cert = (wx['cert_path'], wx['key_path'])
-    resp = requests.post(wx_url, data=xml.encode('utf-8'), headers=_HEADERS, verify=VERIFY, cert=cert)
+    resp = http_util.post(wx_url, data=xml.encode('utf-8'), headers=_HEADERS, verify=VERIFY, cert=cert)
     resp.encoding = 'utf-8'
     try:
         result = xmltodict.parse(resp.text)['xml']
@@ -268,7 +477,7 @@ def query_mch_pay(pay):
     params['sign'] = generate_pay_sign(wx, params)
     xml = current_app.jinja_env.get_template(template).render(**params)
     cert = (wx['cert_path'], wx['key_path'])
-    resp = requests.post(wx_url, data=xml.encode('utf-8'), headers=_HEADERS, verify=VERIFY, cert=cert)
+    resp = http_util.post(wx_url, data=xml.encode('utf-8'), headers=_HEADERS, verify=VERIFY, cert=cert)
     resp.encoding = 'utf-8'
     try:
         result = xmltodict.parse(resp.text)['xml']
@@ -317,7 +526,7 @@ def send_red_pack(pack):
     params['sign'] = generate_pay_sign(wx, params)
     xml = current_app.jinja_env.get_template(template).render(**params)
     cert = (wx['cert_path'], wx['key_path'])
-    resp = requests.post(wx_url, data=xml.encode('utf-8'), headers=_HEADERS, verify=VERIFY, cert=cert)
+    resp = http_util.post(wx_url, data=xml.encode('utf-8'), headers=_HEADERS, verify=VERIFY, cert=cert)
     resp.encoding = 'utf-8'
     try:
         result = xmltodict.parse(resp.text)['xml']
@@ -348,7 +557,7 @@ def query_red_pack(pack):
     params['sign'] = generate_pay_sign(wx, params)
     xml = current_app.jinja_env.get_template(template).render(**params)
     cert = (wx['cert_path'], wx['key_path'])
-    resp = requests.post(wx_url, data=xml.encode('utf-8'), headers=_HEADERS, verify=VERIFY, cert=cert)
+    resp = http_util.post(wx_url, data=xml.encode('utf-8'), headers=_HEADERS, verify=VERIFY, cert=cert)
     resp.encoding = 'utf-8'
     try:
         result = xmltodict.parse(resp.text)['xml']
@@ -372,3 +581,57 @@ def update_red_pack_state(pack):
         current_app.logger.error(u'微信支付发放红包失败')
         send_red_pack(pack)
     # TODO: 微信支付现金红包业务逻辑D'
+
+
+def sync_wx_followers(restart=False):
+    """
+    同步微信公众号全部关注者：分页拉取openid列表，并发批量获取基本信息后批量写入；
+    每批写入后记录断点，中断后再次执行将从断点继续；某批基本信息获取或写入失败时停止同步，不越过该批记录断点
+    :param restart: [bool] 是否忽略断点从头开始
+    :return: 本次同步的用户数；同步失败或已有同步在进行时返回None
+    """
+    wx = current_app.config['WEIXIN']
+    key = 'wx:%s:follower_sync' % wx['app_id']  # 断点：{next_openid, offset}
+    running_key = '%s:running' % key
+    if not redis_client.set(running_key, 1, nx=True, ex=120):
+        current_app.logger.error(u'微信关注者同步正在进行')
+        return
+
+    pool = ThreadPool(WX_FOLLOWER_SYNC_CONCURRENCY)
+    fetch = (lambda openids: get_user_info_batch(wx, openids))
+    try:
+        if restart:
+            redis_client.delete(key)
+        checkpoint = redis_client.hgetall(key)
+        next_openid, offset = checkpoint.get('next_openid') or None, int(checkpoint.get('offset') or 0)
+        count = 0
+        while True:
+            resp_json = get_followers(wx, next_openid)
+            if not resp_json or resp_json.get('errcode'):
+                current_app.logger.error(u'微信关注者列表获取失败: %s' % resp_json)
+                return
+
+            openids = (resp_json.get('data') or {}).get('openid') or []
+            for i in range(offset, len(openids), WX_FOLLOWER_SYNC_BATCH):
+                batch = openids[i:i + WX_FOLLOWER_SYNC_BATCH]
+                infos = sum(pool.map(fetch, [batch[j:j + 100] for j in range(0, len(batch), 100)]), [])
+                if WXUser.upsert_wx_users(infos) is None:
+                    current_app.logger.error(u'微信用户基本信息写入失败(offset: %s)' % i)
+                    return
+                count += len(infos)
+                if len(infos) < len(batch):
+                    current_app.logger.error(u'微信用户基本信息获取失败(%s/%s)' % (len(batch) - len(infos), len(batch)))
+                    return
+                redis_client.hmset(key, {'next_openid': next_openid or '', 'offset': i + len(batch)})
+                redis_client.expire(running_key, 120)
+
+            next_openid, offset = resp_json.get('next_openid'), 0
+            if not (openids and next_openid):
+                break
+            redis_client.hmset(key, {'next_openid': next_openid, 'offset': 0})
+
+        redis_client.delete(key)
+        return count
+    finally:
+        pool.close()
+        redis_client.delete(running_key)
@@ -1,13 +1,38 @@
 # -*- coding: utf-8 -*-
 
-from celery.signals import task_prerun, task_postrun
+import datetime
 
-from . import db, create_celery_app
+from flask import current_app
+from celery.signals import worker_process_init, task_prerun, task_postrun
+from redis.exceptions import ResponseError
+
+from . import db, db_replicas, create_celery_app
+from .models import WXUser, WXPayOrder
+from .constants import WX_USER_INFO_FLUSH_DELAY, WX_PAY_SWEEP_DELAY, WX_PAY_SWEEP_INTERVAL, WX_PAY_SWEEP_MAX_AGE, \
+    WX_PAY_SWEEP_MAX_ORDERS, WX_PAY_SWEEP_BACKOFF, WX_PAY_SWEEP_MAX_INTERVAL, WX_PAY_NOTIFY_FLUSH_DELAY, \
+    WX_PAY_NOTIFY_BATCH, WX_PAY_NOTIFY_CONSUMERS
+from .services.weixin import sync_wx_followers, settle_order, reverse_order, enqueue_pay_notify, drain_pay_notifies, \
+    recover_pay_notifies, count_pending_pay_notifies
+from utils.redis_util import redis_client
+from utils.weixin_util import refresh_credential, get_user_info_batch
 
 
 celery = create_celery_app()
 
 
+@worker_process_init.connect()
+def celery_worker_process_init(sender=None, *args, **kwargs):
+    """
+    celery prefork子进程初始化钩子函数：丢弃从父进程继承的数据库连接
+    :param sender:
+    :param args:
+    :param kwargs:
+    :return:
+    """
+    db.reset()
+    db_replicas.reset()
+
+
 @task_prerun.connect()
 def celery_prerun(sender=None, task=None, task_id=None, *args, **kwargs):
     """
@@ -20,7 +45,7 @@ def celery_prerun(sender=None, task=None, task_id=None, *args, **kwargs):
     :return:
     """
     if db.is_closed():
-        db.connect()
+        db.connect()  # 从连接池取出连接
 
 
 @task_postrun.connect()
@@ -37,4 +62,179 @@ def celery_postrun(sender=None, task=None, task_id=None, retval=None, state=None
     :return:
     """
     if not db.is_closed():
-        db.close()
+        db.close()  # 将连接归还连接池
+    db_replicas.close()
+
+
+@celery.task()
+def refresh_wx_credentials():
+    """
+    提前刷新微信access_token、jsapi_ticket及卡券api_ticket（由celery beat定时调用）
+    :return:
+    """
+    wx = current_app.config['WEIXIN']
+    for name in ('access_token', 'jsapi_ticket', 'card_api_ticket'):
+        if not refresh_credential(wx, name):
+            current_app.logger.error(u'微信%s刷新失败' % name)
+
+
+_WX_USER_INFO_PENDING_KEY = 'wx_user:info:pending'  # 待更新基本信息的微信用户openid集合
+_WX_USER_INFO_FLUSH_KEY = 'wx_user:info:flush'  # 已安排批量更新任务的标记
+
+
+def schedule_wx_user_info_refresh(*openids):
+    """
+    安排更新微信用户基本信息：短时间内的多次请求合并为一次批量获取
+    :param openids:
+    :return:
+    """
+    if not openids:
+        return
+
+    pipe = redis_client.pipeline()
+    pipe.sadd(_WX_USER_INFO_PENDING_KEY, *openids)
+    pipe.set(_WX_USER_INFO_FLUSH_KEY, 1, nx=True, ex=WX_USER_INFO_FLUSH_DELAY * 10)
+    if pipe.execute()[-1]:
+        flush_wx_user_info.apply_async(countdown=WX_USER_INFO_FLUSH_DELAY)
+
+
+@celery.task()
+def flush_wx_user_info():
+    """
+    批量获取并更新待更新的微信用户基本信息
+    :return:
+    """
+    redis_client.delete(_WX_USER_INFO_FLUSH_KEY)  # 此后的请求将安排新的批量更新任务
+    processing_key = '%s:%s' % (_WX_USER_INFO_PENDING_KEY, flush_wx_user_info.request.id)
+    try:
+        redis_client.rename(_WX_USER_INFO_PENDING_KEY, processing_key)
+    except ResponseError:  # 没有待更新的微信用户
+        return
+
+    openids = list(redis_client.smembers(processing_key))
+    redis_client.delete(processing_key)
+    infos = get_user_info_batch(current_app.config['WEIXIN'], openids)
+    if len(infos) < len(openids):
+        current_app.logger.error(u'微信用户基本信息获取失败(%s/%s)' % (len(openids) - len(infos), len(openids)))
+
+    for info in infos:
+        wx_user = WXUser.query_by_openid(info['openid'])
+        if wx_user:
+            wx_user.update_wx_user(**info)
+        else:
+            WXUser.create_wx_user(**info)
+
+
+@celery.task()
+def sync_wx_users(restart=False):
+    """
+    同步微信公众号全部关注者（可断点续传）
+    :param restart: [bool] 是否忽略断点从头开始
+    :return:
+    """
+    return sync_wx_followers(restart)
+
+
+_WX_PAY_SWEEP_RUNNING_KEY = 'wx_pay_order:sweep:running'  # 正在跟进尚未确认支付结果的订单的标记
+
+
+@celery.task()
+def sweep_wx_pay_orders():
+    """
+    跟进尚未确认支付结果的微信支付订单（由celery beat定时调用）：按游标分页扫描（用户支付中的订单及新订单优先），
+    同一订单的跟进间隔随订单已创建时间增加（WX_PAY_SWEEP_INTERVAL至WX_PAY_SWEEP_MAX_INTERVAL），
+    每次最多安排WX_PAY_SWEEP_MAX_ORDERS个，由settle_wx_pay_order任务并发处理（并发数取决于celery worker）
+    :return: 安排跟进的订单数
+    """
+    if not redis_client.set(_WX_PAY_SWEEP_RUNNING_KEY, 1, nx=True, ex=60):
+        return
+
+    try:
+        now = datetime.datetime.now()
+        start_time = now - datetime.timedelta(seconds=WX_PAY_SWEEP_MAX_AGE)
+        end_time = now - datetime.timedelta(seconds=WX_PAY_SWEEP_DELAY)
+        count = 0
+        for order in WXPayOrder.iter_pending(start_time, end_time):
+            age = (now - order.create_time).total_seconds()
+            interval = int(min(max(age * WX_PAY_SWEEP_BACKOFF, WX_PAY_SWEEP_INTERVAL), WX_PAY_SWEEP_MAX_INTERVAL))
+            if redis_client.set('wx_pay_order:%s:settle' % order.id, 1, nx=True, ex=interval):
+                settle_wx_pay_order.delay(order.id)
+                count += 1
+                if count >= WX_PAY_SWEEP_MAX_ORDERS:
+                    break
+        return count
+    finally:
+        redis_client.delete(_WX_PAY_SWEEP_RUNNING_KEY)
+
+
+@celery.task()
+def settle_wx_pay_order(order_id):
+    """
+    跟进尚未确认支付结果的微信支付订单
+    :param order_id:
+    :return:
+    """
+    order = WXPayOrder.query_by_id(order_id)
+    if order:
+        settle_order(order)
+
+
+@celery.task()
+def reverse_wx_pay_order(order_id):
+    """
+    重试关闭/撤销支付失败的微信支付订单
+    :param order_id:
+    :return:
+    """
+    order = WXPayOrder.query_by_id(order_id)
+    if order:
+        reverse_order(order)
+
+
+_WX_PAY_NOTIFY_FLUSH_KEY = 'wx_pay:notify:flush'  # 已安排批量处理任务的标记
+
+
+def _schedule_wx_pay_notify_flush():
+    """
+    安排批量处理微信支付结果/退款结果通知的任务（已安排时不重复安排）
+    :return:
+    """
+    if redis_client.set(_WX_PAY_NOTIFY_FLUSH_KEY, 1, nx=True, ex=WX_PAY_NOTIFY_FLUSH_DELAY * 10):
+        flush_wx_pay_notify.apply_async(countdown=WX_PAY_NOTIFY_FLUSH_DELAY)
+
+
+def schedule_wx_pay_notify(kind, data):
+    """
+    安排处理微信支付结果/退款结果通知：存入redis队列，短时间内的多个通知合并为一次批量处理
+    :param kind: 'pay' or 'refund'
+    :param data: [dict] 已验证签名/解密的通知内容
+    :return:
+    """
+    enqueue_pay_notify(kind, data)
+    _schedule_wx_pay_notify_flush()
+
+
+@celery.task()
+def flush_wx_pay_notify(spawn=True):
+    """
+    处理队列中的微信支付结果/退款结果通知：通知较多时另外安排任务并发处理，共最多WX_PAY_NOTIFY_CONSUMERS个
+    :param spawn: [bool] 是否另外安排任务
+    :return:
+    """
+    redis_client.delete(_WX_PAY_NOTIFY_FLUSH_KEY)  # 此后的通知将安排新的处理任务
+    if spawn:
+        consumers = min(WX_PAY_NOTIFY_CONSUMERS, count_pending_pay_notifies() // WX_PAY_NOTIFY_BATCH + 1)
+        for i in range(consumers - 1):
+            flush_wx_pay_notify.apply_async((False,))
+    drain_pay_notifies(flush_wx_pay_notify.request.id)
+
+
+@celery.task()
+def recover_wx_pay_notifies():
+    """
+    （由celery beat定时调用）将中断的任务正在处理的通知放回队列，队列中有通知时安排处理
+    :return:
+    """
+    recover_pay_notifies()
+    if count_pending_pay_notifies():
+        _schedule_wx_pay_notify_flush()
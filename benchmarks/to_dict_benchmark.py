@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+比较BaseModel.to_dicts（预编译执行计划、批量获取原始数据）与playhouse.shortcuts.model_to_dict（逐个对象查询原始数据）的性能，
+每页均从数据库（SQLite内存数据库）重新加载，包括查询WXPayPayload
+
+    python benchmarks/to_dict_benchmark.py [rows] [repeat]
+"""
+
+import os
+import sys
+import timeit
+import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from peewee import SqliteDatabase
+from playhouse.shortcuts import model_to_dict
+from playhouse.test_utils import test_database
+
+from app.models import WXPayOrder, WXPayPayload
+
+
+class CountingDatabase(SqliteDatabase):
+    """
+    记录执行的SQL语句数
+    """
+    queries = 0
+
+    def execute_sql(self, sql, params=None, require_commit=True):
+        self.queries += 1
+        return super(CountingDatabase, self).execute_sql(sql, params, require_commit)
+
+
+def make_orders(rows):
+    """
+    构造微信支付订单及其原始数据（每个类别保存两次，取最近一次）
+    :param rows:
+    :return:
+    """
+    now = datetime.datetime.now()
+    result = {'return_code': 'SUCCESS', 'result_code': 'SUCCESS', 'prepay_id': 'wx%s' % ('0' * 30)}
+    WXPayOrder.insert_many([{'create_time': now, 'update_time': now, 'body': u'商品', 'out_trade_no': '%032d' % i,
+                             'total_fee': 100, 'spbill_create_ip': '127.0.0.1', 'trade_type': 'JSAPI'}
+                            for i in range(rows)]).execute()
+    WXPayPayload.insert_many([{'create_time': now, 'object_type': WXPayOrder._meta.db_table,
+                               'object_id': order.id, 'kind': kind, 'payload': dict(result, attempt=attempt)}
+                              for attempt in range(2) for order in WXPayOrder.select()
+                              for kind in WXPayOrder._payload_kinds()]).execute()
+
+
+def generic_to_dict(obj, only=None):
+    """
+    原有实现：每次调用重新计算字段集合并经过model_to_dict
+    :param obj:
+    :param only:
+    :return:
+    """
+    only = set(only) if only else set()
+    exclude = obj._exclude_fields()
+    _fields = obj._meta.fields
+    only_fields = {_fields[k] for k in only if k in _fields}
+    exclude_fields = {_fields[k] for k in exclude if k in _fields}
+    extra_attrs = obj._extra_attributes() - exclude
+    if only:
+        extra_attrs &= only
+        if not only_fields:
+            exclude_fields = _fields.values()
+    return model_to_dict(obj, recurse=False, only=only_fields, exclude=exclude_fields, extra_attrs=extra_attrs)
+
+
+def measure(database, page, repeat):
+    """
+    :param database:
+    :param page: 加载一页并转换为dict表示的函数
+    :param repeat:
+    :return: (ms/page, queries/page)
+    """
+    database.queries = 0
+    page()
+    queries = database.queries
+    seconds = min(timeit.repeat(page, number=repeat, repeat=3))
+    return seconds * 1000 / repeat, queries
+
+
+def main(rows=20, repeat=50):
+    database = CountingDatabase(':memory:')
+    with Flask(__name__).app_context(), test_database(database, [WXPayOrder, WXPayPayload]):
+        make_orders(rows)
+        query = lambda: list(WXPayOrder.select().order_by(WXPayOrder.id).limit(rows))
+        for only in (None, ['id', 'out_trade_no', 'total_fee', 'trade_state', 'iso_create_time']):
+            assert [generic_to_dict(o, only) for o in query()] == WXPayOrder.to_dicts(query(), only)
+            generic = measure(database, lambda: [generic_to_dict(o, only) for o in query()], repeat)
+            to_dict = measure(database, lambda: [o.to_dict(only) for o in query()], repeat)
+            to_dicts = measure(database, lambda: WXPayOrder.to_dicts(query(), only), repeat)
+            print('only=%s, %s rows x %s:' % (only, rows, repeat))
+            print('  model_to_dict  %.2f ms/page, %s queries/page' % generic)
+            print('  to_dict        %.2f ms/page, %s queries/page' % to_dict)
+            print('  to_dicts       %.2f ms/page, %s queries/page' % to_dicts)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:3]))
@@ -1,10 +1,25 @@
 # -*- coding: utf-8 -*-
 
 from os import environ
+from datetime import timedelta
 from logging.handlers import RotatingFileHandler
 import logging
 
 
+def _mysql_replicas(mysql, hosts):
+    """
+    mysql从库的连接参数：用户、密码及数据库与主库相同
+    :param mysql: 主库的连接参数
+    :param hosts: [str or None] 英文逗号分隔的host[:port]
+    :return:
+    """
+    replicas = []
+    for item in filter(None, (hosts or '').split(',')):
+        host, _, port = item.strip().partition(':')
+        replicas.append(dict(mysql, host=host, port=int(port or mysql['port'])))
+    return replicas
+
+
 class Config(object):
     """
     配置
@@ -21,6 +36,22 @@ class Config(object):
         'database': environ.get('FLASK_MYSQL_DB') or _project_name.replace('-', '_')
     }
 
+    # mysql从库（可选）：GET请求及标记了read_replica的celery任务中的查询使用从库
+    MYSQL_REPLICAS = _mysql_replicas(MYSQL, environ.get('FLASK_MYSQL_REPLICA_HOSTS'))
+    MYSQL_REPLICA_RETRY_INTERVAL = 30  # 连接或查询失败的从库在该时间（秒）内不再使用
+    MYSQL_STICKY_SECONDS = 5  # 写入后该时间（秒）内同一会话的查询仍使用主库（读己之写），应大于从库的复制延迟
+
+    # mysql连接池
+    MYSQL_POOL = {
+        'max_connections': int(environ.get('FLASK_MYSQL_MAX_CONNECTIONS') or 20),  # 每个进程的最大连接数
+        'stale_timeout': int(environ.get('FLASK_MYSQL_STALE_TIMEOUT') or 300),  # 连接的最长使用时间（秒），应小于MySQL的wait_timeout
+        'timeout': int(environ.get('FLASK_MYSQL_POOL_TIMEOUT') or 10),  # 连接数已满时等待空闲连接的最长时间（秒）
+        'ping_interval': int(environ.get('FLASK_MYSQL_PING_INTERVAL') or 30)  # 空闲超过该时间（秒）的连接在取出时先ping检查
+    }
+
+    # 请求/celery任务范围内的identity map（可选）：同一主键只查询一次
+    IDENTITY_MAP = environ.get('FLASK_IDENTITY_MAP') == '1'
+
     # celery
     BROKER_URL = 'amqp://%s:%s@%s:%s/%s' % (environ.get('CELERY_BROKER_USER'),
                                             environ.get('CELERY_BROKER_PASSWORD'),
@@ -34,6 +65,20 @@ class Config(object):
     CELERY_TASK_SERIALIZER = 'pickle'
     CELERY_RESULT_SERIALIZER = 'pickle'
     CELERY_TIMEZONE = 'Asia/Shanghai'
+    CELERYBEAT_SCHEDULE = {
+        'refresh-wx-credentials': {
+            'task': 'app.tasks.refresh_wx_credentials',
+            'schedule': timedelta(minutes=5)  # 微信凭证在过期前20分钟内刷新，至少有3次机会
+        },
+        'sweep-wx-pay-orders': {
+            'task': 'app.tasks.sweep_wx_pay_orders',
+            'schedule': timedelta(seconds=10)
+        },
+        'recover-wx-pay-notifies': {
+            'task': 'app.tasks.recover_wx_pay_notifies',
+            'schedule': timedelta(minutes=1)
+        }
+    }
 
     # 七牛
     QINIU = {
@@ -62,6 +107,8 @@ class Config(object):
         'cert_path': environ.get('WEIXIN_CERT_PATH'),
         'key_path': environ.get('WEIXIN_KEY_PATH')
     }
+    # 微信支付结果/退款结果通知验证后存入redis队列并立即回复，由celery任务批量处理
+    WX_PAY_NOTIFY_ASYNC = environ.get('WEIXIN_PAY_NOTIFY_ASYNC') == '1'
 
     @staticmethod
     def init_app(app):
@@ -1,13 +1,60 @@
 # -*- coding: utf-8 -*-
 
 import os
+import time
+
+import click
 
 from app import socketio, create_app
 from app.tasks import celery
+from app.models import models, BaseModel
+from app.services.weixin import sync_wx_followers
 
 
 app = create_app(os.getenv('FLASK_CONFIG') or 'default')
 
 
+@app.cli.command('sync_wx_followers')
+@click.option('--restart', is_flag=True, help=u'忽略断点从头开始同步')
+def sync_wx_followers_command(restart):
+    """
+    同步微信公众号全部关注者
+    :param restart:
+    :return:
+    """
+    count = sync_wx_followers(restart)
+    click.echo(u'同步失败' if count is None else u'同步完成：%s' % count)
+
+
+@app.cli.command('migrate_payloads')
+@click.option('--batch-size', default=500, help=u'每批读取的行数')
+@click.option('--sleep', default=0.1, help=u'每批之间的间隔（秒）')
+def migrate_payloads_command(batch_size, sleep):
+    """
+    将主表中历史的微信支付响应结果等原始数据移入wx_pay_payload表（在线分批执行，可重复执行）
+    :param batch_size:
+    :param sleep:
+    :return:
+    """
+    for model in [m for m in models if issubclass(m, BaseModel)]:  # wx_pay_payload表本身没有原始数据列
+        after_id, total = 0, 0
+        while after_id is not None:
+            after_id, migrated = model.migrate_payloads(after_id, batch_size)
+            total += migrated
+            time.sleep(sleep)
+        click.echo(u'%s：%s' % (model._meta.db_table, total))
+
+
+@app.cli.command('migrate_schema')
+def migrate_schema_command():
+    """
+    为已存在的表添加新增的字段及索引
+    :return:
+    """
+    for model in models:
+        for name in model.add_missing_columns() + model.add_missing_indexes():
+            click.echo(u'%s：%s' % (model._meta.db_table, name))
+
+
 if __name__ == '__main__':
     socketio.run(app)
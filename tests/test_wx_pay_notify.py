@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import unittest
+
+from flask import Flask
+import fakeredis
+
+from app.services import weixin
+
+
+class DrainPayNotifiesTestCase(unittest.TestCase):
+    """
+    微信支付结果/退款结果通知队列：处理失败或中断的通知不丢失
+    """
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        self.redis.flushall()
+        self.patches = {
+            'redis_client': self.redis,
+            'handle_pay_notify': self._handle_pay_notify,
+            'handle_refund_notify': lambda data, refund: None
+        }
+        self.originals = {name: getattr(weixin, name) for name in self.patches}
+        for name, value in self.patches.items():
+            setattr(weixin, name, value)
+        self.query_by_out_trade_nos = weixin.WXPayOrder.query_by_out_trade_nos
+        self.query_by_out_refund_nos = weixin.WXPayRefund.query_by_out_refund_nos
+        weixin.WXPayOrder.query_by_out_trade_nos = classmethod(lambda cls, nos: {no: no for no in nos})
+        weixin.WXPayRefund.query_by_out_refund_nos = classmethod(lambda cls, nos: {no: no for no in nos})
+        self.handled = []
+        self.failing = set()
+        self.app_context = Flask(__name__).app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        self.app_context.pop()
+        for name, value in self.originals.items():
+            setattr(weixin, name, value)
+        weixin.WXPayOrder.query_by_out_trade_nos = self.query_by_out_trade_nos
+        weixin.WXPayRefund.query_by_out_refund_nos = self.query_by_out_refund_nos
+
+    def _handle_pay_notify(self, data, order):
+        if order in self.failing:
+            raise ValueError(order)
+        self.handled.append(order)
+
+    def _pending(self):
+        return [json.loads(item) for item in self.redis.lrange(weixin._PAY_NOTIFY_PENDING_KEY, 0, -1)]
+
+    def _processing(self, consumer):
+        return self.redis.llen(weixin._PAY_NOTIFY_PROCESSING_KEY % consumer)
+
+    def test_drain(self):
+        for no in ('1', '2', '3'):
+            weixin.enqueue_pay_notify('pay', {'out_trade_no': no})
+        self.assertEqual(weixin.drain_pay_notifies('c1', batch_size=2), 3)
+        self.assertEqual(self.handled, ['1', '2', '3'])
+        self.assertEqual(self._pending(), [])
+        self.assertEqual(self._processing('c1'), 0)
+        self.assertEqual(self.redis.zcard(weixin._PAY_NOTIFY_CONSUMERS_KEY), 0)
+
+    def test_query_failure_requeues_notifies(self):
+        weixin.enqueue_pay_notify('pay', {'out_trade_no': '1'})
+
+        def fail(cls, nos):
+            raise IOError('database unavailable')
+        weixin.WXPayOrder.query_by_out_trade_nos = classmethod(fail)
+        self.assertRaises(IOError, weixin.drain_pay_notifies, 'c1')
+        self.assertEqual(self._pending(), [['pay', {'out_trade_no': '1'}, 0]])
+        self.assertEqual(self._processing('c1'), 0)
+
+    def test_handler_failure_retries_then_gives_up(self):
+        self.failing.add('1')
+        weixin.enqueue_pay_notify('pay', {'out_trade_no': '1'})
+        weixin.enqueue_pay_notify('pay', {'out_trade_no': '2'})
+        weixin.drain_pay_notifies('c1')
+        self.assertEqual(self.handled, ['2'])
+        self.assertEqual(self._pending(), [])
+        failed = [json.loads(item) for item in self.redis.lrange(weixin._PAY_NOTIFY_FAILED_KEY, 0, -1)]
+        self.assertEqual(failed, [['pay', {'out_trade_no': '1'}, weixin.WX_PAY_NOTIFY_MAX_ATTEMPTS]])
+
+    def test_concurrent_consumers(self):
+        for no in ('1', '2', '3'):
+            weixin.enqueue_pay_notify('pay', {'out_trade_no': no})
+
+        def handle(data, order):
+            if order == '1':  # 第一个消费者处理期间，第二个消费者取出其余的通知
+                weixin.drain_pay_notifies('c2')
+            self.handled.append(order)
+        weixin.handle_pay_notify = handle
+        weixin.drain_pay_notifies('c1', batch_size=1)
+        self.assertEqual(sorted(self.handled), ['1', '2', '3'])
+        self.assertEqual(self._pending(), [])
+
+    def test_recover_interrupted_consumer(self):
+        weixin.enqueue_pay_notify('pay', {'out_trade_no': '1'})
+        self.redis.rpoplpush(weixin._PAY_NOTIFY_PENDING_KEY, weixin._PAY_NOTIFY_PROCESSING_KEY % 'c1')
+        self.redis.zadd(weixin._PAY_NOTIFY_CONSUMERS_KEY, time.time(), 'c1')
+        self.assertEqual(weixin.recover_pay_notifies(), 0)
+
+        self.redis.zadd(weixin._PAY_NOTIFY_CONSUMERS_KEY, time.time() - weixin.WX_PAY_NOTIFY_CONSUMER_TIMEOUT - 1, 'c1')
+        self.assertEqual(weixin.recover_pay_notifies(), 1)
+        self.assertEqual(self._processing('c1'), 0)
+        weixin.drain_pay_notifies('c2')
+        self.assertEqual(self.handled, ['1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
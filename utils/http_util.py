@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+import os
+import ssl
+import time
+import threading
+from urlparse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE') or 10)  # 每个域名的最大连接数
+KEEP_ALIVE = int(os.getenv('HTTP_KEEP_ALIVE') or 60)  # 空闲连接的保持时间（秒），超过后重建会话
+TIMEOUT = (float(os.getenv('HTTP_CONNECT_TIMEOUT') or 5), float(os.getenv('HTTP_READ_TIMEOUT') or 30))
+
+_sessions = {}  # {(pid, scheme, host, cert): [session, last_used, cert_version]}
+_ssl_contexts = {}  # {(pid, cert, verify): (cert_version, ssl_context)}
+_lock = threading.Lock()
+
+
+class _SSLContextAdapter(HTTPAdapter):
+    """
+    使用预先加载了客户端证书的SSLContext的连接池适配器
+    """
+    def __init__(self, ssl_context, **kwargs):
+        self.ssl_context = ssl_context
+        super(_SSLContextAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['ssl_context'] = self.ssl_context
+        return super(_SSLContextAdapter, self).init_poolmanager(*args, **kwargs)
+
+
+def _get_ssl_context(cert, verify, version):
+    """
+    获取加载了客户端证书的SSLContext（双向TLS）：每个进程只在首次使用及证书文件修改后从磁盘加载
+    :param cert: (cert_path, key_path)
+    :param verify: CA证书路径或False
+    :param version: 证书文件的修改时间
+    :return:
+    """
+    key = (os.getpid(), cert, verify)
+    item = _ssl_contexts.get(key)
+    if item and item[0] == version:
+        return item[1]
+
+    context = ssl.create_default_context(cafile=verify if isinstance(verify, basestring) else None)
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    context.load_cert_chain(*cert)
+    _ssl_contexts[key] = (version, context)
+    return context
+
+
+def _create_session(cert=None, verify=True, version=None):
+    """
+    创建带连接池的会话
+    :param cert: [tuple or None] (cert_path, key_path)
+    :param verify:
+    :param version: 证书文件的修改时间
+    :return:
+    """
+    session = requests.Session()
+    kwargs = {
+        'pool_connections': 1,
+        'pool_maxsize': POOL_SIZE,
+        'pool_block': False
+    }
+    if cert:
+        adapter = _SSLContextAdapter(_get_ssl_context(cert, verify, version), **kwargs)
+    else:
+        adapter = HTTPAdapter(**kwargs)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _cert_version(cert):
+    """
+    客户端证书文件的修改时间，用于在证书更新后重新加载
+    :param cert: [tuple or None]
+    :return:
+    """
+    return tuple(map(os.path.getmtime, cert)) if cert else None
+
+
+def get_session(url, cert=None, verify=True):
+    """
+    获取url所在域名的会话：按进程、域名及客户端证书复用连接池，fork出的子进程（如celery prefork worker）使用各自的会话
+    :param url:
+    :param cert: [tuple or None] (cert_path, key_path)，证书文件只在首次使用及修改后加载
+    :param verify:
+    :return:
+    """
+    parsed = urlparse(url)
+    cert = tuple(cert) if cert else None
+    key = (os.getpid(), parsed.scheme, parsed.netloc, cert)
+    version = _cert_version(cert)
+    now = time.time()
+    with _lock:
+        item = _sessions.get(key)
+        if item and (now - item[1] > KEEP_ALIVE or item[2] != version):
+            item[0].close()  # 空闲过久的连接可能已被服务端关闭；证书更新后需重新加载
+            item = None
+        if not item:
+            item = _sessions[key] = [_create_session(cert, verify, version), now, version]
+        item[1] = now
+        return item[0]
+
+
+def request(method, url, **kwargs):
+    """
+    使用连接池发送HTTP请求，参数同requests.request
+    :param method:
+    :param url:
+    :param kwargs:
+    :return:
+    """
+    kwargs.setdefault('timeout', TIMEOUT)
+    session = get_session(url, kwargs.pop('cert', None), kwargs.get('verify', True))
+    return session.request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
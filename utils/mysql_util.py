@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import threading
+
+from peewee import OperationalError
+from playhouse.pool import PooledMySQLDatabase as _PooledMySQLDatabase
+
+
+class PooledMySQLDatabase(_PooledMySQLDatabase):
+    """
+    MySQL连接池：
+    连接状态保存在threading.local中，gunicorn eventlet worker在加载应用前已monkey patch，每个green thread各自取出/归还连接；
+    fork出的子进程（如celery prefork worker）丢弃从父进程继承的连接，使用各自的连接池；
+    连接归还后空闲超过ping_interval秒才在取出时ping检查，避免每次取出都多一次往返
+    """
+    def __init__(self, database, ping_interval=30, **kwargs):
+        self.ping_interval = ping_interval
+        self.on_write = None  # 执行非SELECT语句后的回调函数
+        self._pid = os.getpid()
+        self._returned = {}  # {conn_key: 归还时间}
+        super(PooledMySQLDatabase, self).__init__(database, **kwargs)
+
+    def init(self, database, ping_interval=None, **kwargs):
+        if ping_interval is not None:
+            self.ping_interval = ping_interval
+        super(PooledMySQLDatabase, self).init(database, **kwargs)
+
+    def reset(self):
+        """
+        丢弃从父进程继承的全部连接（不关闭，以免影响父进程中的同一socket）
+        :return:
+        """
+        self._pid = os.getpid()
+        self._local = type(self._local)()
+        self._conn_lock = threading.Lock()
+        self._connections = []
+        self._in_use = {}
+        self._closed = set()
+        self._returned = {}
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self.reset()
+
+    def connect(self):
+        self._check_pid()
+        super(PooledMySQLDatabase, self).connect()
+
+    def is_closed(self):
+        self._check_pid()
+        return super(PooledMySQLDatabase, self).is_closed()
+
+    def get_conn(self):
+        self._check_pid()
+        return super(PooledMySQLDatabase, self).get_conn()
+
+    def execute_sql(self, sql, params=None, require_commit=True):
+        cursor = super(PooledMySQLDatabase, self).execute_sql(sql, params, require_commit)
+        if self.on_write and not sql.lstrip()[:6].upper() == 'SELECT':
+            self.on_write()
+        return cursor
+
+    def _is_closed(self, key, conn):
+        if key in self._closed:
+            return True
+        if time.time() - self._returned.pop(key, 0) < self.ping_interval:
+            return False
+        try:
+            conn.ping(False)
+        except Exception:
+            return True
+        return False
+
+    def _close(self, conn, close_conn=False):
+        key = self.conn_key(conn)
+        super(PooledMySQLDatabase, self)._close(conn, close_conn)
+        if not close_conn and any(c is conn for ts, c in self._connections):
+            self._returned[key] = time.time()
+        else:
+            self._returned.pop(key, None)
+
+
+class _ReplicaDatabase(PooledMySQLDatabase):
+    """
+    从库：查询失败时将其标记为不可用，并在主库上重新执行
+    """
+    def __init__(self, database, replica_set, **kwargs):
+        self.replica_set = replica_set
+        super(_ReplicaDatabase, self).__init__(database, **kwargs)
+
+    def execute_sql(self, sql, params=None, require_commit=True):
+        if self.replica_set.is_down(self):
+            return self.replica_set.primary.execute_sql(sql, params, require_commit)
+        try:
+            return super(_ReplicaDatabase, self).execute_sql(sql, params, require_commit)
+        except OperationalError:
+            self.replica_set.mark_down(self)
+            return self.replica_set.primary.execute_sql(sql, params, require_commit)
+
+
+class ReplicaSet(object):
+    """
+    MySQL从库集合：轮流使用各从库，连接或查询失败的从库在retry_interval秒内不再使用
+    """
+    def __init__(self, primary, retry_interval=30):
+        self.primary = primary
+        self.retry_interval = retry_interval
+        self.databases = []
+        self._down_until = {}
+        self._index = -1
+
+    def init(self, configs, **pool_kwargs):
+        """
+        :param configs: [list] 各从库的连接参数，同主库
+        :param pool_kwargs: 连接池参数
+        :return:
+        """
+        self.databases = []
+        self._down_until = {}
+        for config in configs:
+            database = _ReplicaDatabase(None, self)
+            database.init(**dict(config, **pool_kwargs))
+            self.databases.append(database)
+
+    def mark_down(self, database):
+        """
+        标记从库不可用，并丢弃当前连接
+        :param database:
+        :return:
+        """
+        self._down_until[database] = time.time() + self.retry_interval
+        try:
+            database.manual_close()
+        except Exception:
+            pass
+
+    def is_down(self, database):
+        return self._down_until.get(database, 0) > time.time()
+
+    def get(self):
+        """
+        取出一个可用从库的连接
+        :return: 从库，均不可用或未配置时返回None
+        """
+        for i in range(len(self.databases)):
+            self._index = (self._index + 1) % len(self.databases)
+            database = self.databases[self._index]
+            if self.is_down(database):
+                continue
+            try:
+                if database.is_closed():
+                    database.connect()
+                return database
+            except Exception:
+                self.mark_down(database)
+
+    def close(self):
+        """
+        将各从库的连接归还连接池
+        :return:
+        """
+        for database in self.databases:
+            if not database.is_closed():
+                database.close()
+
+    def reset(self):
+        for database in self.databases:
+            database.reset()
@@ -5,109 +5,291 @@ import time
 import json
 import hashlib
 
-import requests
+from redis.exceptions import LockError
 
+from . import http_util
 from .key_util import generate_random_key
 from .redis_util import redis_client
 
 
 VERIFY = os.getenv('CA_CERTS_PATH') or False
 
+_REFRESH_REQUEST_TIMEOUT = (3, 5)  # 刷新凭证时请求微信接口的(连接, 读取)超时时间（秒）
+_REFRESH_LOCK_TIMEOUT = 40  # 凭证刷新锁的超时时间（秒），大于刷新期间最多4次请求的超时时间之和，避免刷新未完成时锁已过期
+_REFRESH_WAIT_TIMEOUT = 5  # 等待其他进程刷新凭证的最长时间（秒）
+_REFRESH_AHEAD = 1200  # 凭证剩余有效时间少于20分钟时提前刷新
+_EXPIRES_MARGIN = 300  # 凭证在redis中比实际有效期提前5分钟过期
+_LOCAL_TTL_IN_REFRESH_WINDOW = 60  # 进入提前刷新时段后进程内缓存的最长有效时间（秒）
+_INVALID_TOKEN_ERRCODES = (40001, 40014, 42001)  # access_token无效/不合法/超时
 
-def get_access_token(wx):
+_local_cache = {}  # 进程内缓存：{key: (value, expires_at)}
+
+
+def _get_local(key):
     """
-    获取微信access_token
+    读取进程内缓存
+    :param key:
+    :return:
+    """
+    item = _local_cache.get(key)
+    if item and item[1] > time.time():
+        return item[0]
+
+
+def _set_local(key, value, ttl):
+    """
+    写入进程内缓存：在redis中对应键进入提前刷新时段时过期，以便及时读取刷新后的凭证
+    :param key:
+    :param value:
+    :param ttl: redis中对应键的剩余有效时间（秒）
+    :return:
+    """
+    if not (value and ttl > 0):
+        return
+
+    local_ttl = ttl - _REFRESH_AHEAD
+    if local_ttl <= 0:
+        local_ttl = min(ttl, _LOCAL_TTL_IN_REFRESH_WINDOW)
+    _local_cache[key] = (value, time.time() + local_ttl)
+
+
+def _get_cached(key, local=True):
+    """
+    依次从进程内缓存、redis中读取微信凭证
+    :param key:
+    :param local: [bool] 是否读取进程内缓存
+    :return: (value, ttl)，ttl为None表示来自进程内缓存
+    """
+    if local:
+        value = _get_local(key)
+        if value:
+            return value, None
+
+    value, ttl = redis_client.pipeline().get(key).ttl(key).execute()
+    if value:
+        _set_local(key, value, ttl)
+    return value, ttl
+
+
+def _refresh(key, fetch, force=False, stale=None):
+    """
+    加锁刷新微信凭证：同一时刻只有一个进程请求微信接口，其余进程等待后重新读取
+    :param key:
+    :param fetch: 请求微信接口的函数，返回(value, expires_in)
+    :param force: [bool] 为False时仅在凭证缺失或即将过期时刷新
+    :param stale: 已失效的凭证；若当前凭证已不同于此值，说明已由其他进程刷新，不再重复刷新
+    :return:
+    """
+    lock = redis_client.lock('%s:lock' % key, timeout=_REFRESH_LOCK_TIMEOUT, blocking_timeout=_REFRESH_WAIT_TIMEOUT)
+    if not lock.acquire():
+        return _get_cached(key, local=False)[0]
+
+    try:
+        value, ttl = _get_cached(key, local=False)  # 等待锁期间可能已由其他进程刷新
+        if value and stale:
+            if value != stale:
+                return value
+        elif value and not force and ttl > _REFRESH_AHEAD:
+            return value
+
+        new_value, expires_in = fetch()
+        if not (new_value and expires_in):
+            return None if stale else value  # 刷新失败时继续使用原有凭证
+
+        ttl = int(expires_in) - _EXPIRES_MARGIN
+        redis_client.set(key, new_value, ex=ttl)
+        _set_local(key, new_value, ttl)
+        return new_value
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            pass
+
+
+def _get_or_refresh(key, fetch):
+    """
+    读取缓存的微信凭证，缓存缺失时加锁刷新
+    :param key:
+    :param fetch: 请求微信接口的函数，返回(value, expires_in)
+    :return:
+    """
+    value = _get_cached(key)[0]
+    if value:
+        return value
+
+    return _refresh(key, fetch)
+
+
+def _credential_key(wx, name):
+    """
+    微信凭证在redis中的键
     :param wx: [dict]
+    :param name: 'access_token'，'jsapi_ticket'，'card_api_ticket'
     :return:
     """
     app_id, app_secret = map(wx.get, ('app_id', 'app_secret'))
-    if not (app_id and app_secret):
-        return
+    if app_id and app_secret:
+        return 'wx:%s:%s' % (app_id, name)
 
-    key = 'wx:%s:access_token' % app_id
-    access_token = redis_client.get(key)
-    if access_token:
-        return access_token
 
+def _fetch_access_token(wx):
+    """
+    请求微信接口获取access_token
+    :param wx: [dict]
+    :return: (access_token, expires_in)
+    """
     wx_url = 'https://api.weixin.qq.com/cgi-bin/token'
     params = {
         'grant_type': 'client_credential',
-        'appid': app_id,
-        'secret': app_secret
+        'appid': wx['app_id'],
+        'secret': wx['app_secret']
     }
-    resp_json = requests.get(wx_url, params=params, verify=VERIFY).json()
-    access_token, expires_in = map(resp_json.get, ('access_token', 'expires_in'))
-    if not (access_token and expires_in):
-        return
+    resp_json = http_util.get(wx_url, params=params, verify=VERIFY, timeout=_REFRESH_REQUEST_TIMEOUT).json()
+    return map(resp_json.get, ('access_token', 'expires_in'))
 
-    redis_client.set(key, access_token, ex=int(expires_in) - 600)  # 提前10分钟更新access_token
-    return access_token
 
+def _fetch_ticket(wx, ticket_type):
+    """
+    请求微信接口获取jsapi_ticket/卡券api_ticket
+    :param wx: [dict]
+    :param ticket_type: 'jsapi' - jsapi_ticket，'wx_card' - 卡券api_ticket
+    :return: (ticket, expires_in)
+    """
+    wx_url = 'https://api.weixin.qq.com/cgi-bin/ticket/getticket'
+    params = {
+        'type': ticket_type
+    }
+    resp = _call_api(wx, 'GET', wx_url, params=params, timeout=_REFRESH_REQUEST_TIMEOUT)
+    if resp is None:
+        return None, None
 
-def get_jsapi_ticket(wx):
+    return map(resp.json().get, ('ticket', 'expires_in'))
+
+
+_CREDENTIALS = {  # 微信凭证名称对应获取函数
+    'access_token': _fetch_access_token,
+    'jsapi_ticket': (lambda wx: _fetch_ticket(wx, 'jsapi')),
+    'card_api_ticket': (lambda wx: _fetch_ticket(wx, 'wx_card'))
+}
+
+
+def _get_credential(wx, name):
     """
-    获取微信jsapi_ticket
+    获取微信凭证
     :param wx: [dict]
+    :param name:
     :return:
     """
-    app_id, app_secret = map(wx.get, ('app_id', 'app_secret'))
-    if not (app_id and app_secret):
-        return
+    key = _credential_key(wx, name)
+    if key:
+        return _get_or_refresh(key, lambda: _CREDENTIALS[name](wx))
 
-    key = 'wx:%s:jsapi_ticket' % app_id
-    jsapi_ticket = redis_client.get(key)
-    if jsapi_ticket:
-        return jsapi_ticket
 
-    access_token = get_access_token(wx)
-    if not access_token:
-        return
+def refresh_credential(wx, name, force=False):
+    """
+    提前刷新微信凭证（由定时任务调用），刷新完成前仍使用原有凭证
+    :param wx: [dict]
+    :param name: 'access_token'，'jsapi_ticket'，'card_api_ticket'
+    :param force: [bool]
+    :return:
+    """
+    key = _credential_key(wx, name)
+    if key:
+        return _refresh(key, lambda: _CREDENTIALS[name](wx), force)
 
-    wx_url = 'https://api.weixin.qq.com/cgi-bin/ticket/getticket'
-    params = {
-        'access_token': access_token,
-        'type': 'jsapi'
-    }
-    resp_json = requests.get(wx_url, params=params, verify=VERIFY).json()
-    jsapi_ticket, expires_in = map(resp_json.get, ('ticket', 'expires_in'))
-    if not (jsapi_ticket and expires_in):
+
+def _invalidate_access_token(wx, access_token):
+    """
+    access_token被微信判定失效时清除缓存并刷新；并发的多次失效只触发一次刷新
+    :param wx: [dict]
+    :param access_token: 已失效的access_token
+    :return:
+    """
+    key = _credential_key(wx, 'access_token')
+    if _local_cache.get(key, (None,))[0] == access_token:
+        _local_cache.pop(key, None)
+    return _refresh(key, lambda: _fetch_access_token(wx), stale=access_token)
+
+
+def _errcode(resp):
+    """
+    微信接口响应中的错误码（非JSON响应返回None）
+    :param resp:
+    :return:
+    """
+    content_type = resp.headers.get('Content-Type') or ''
+    if content_type.startswith(('image/', 'audio/', 'video/')):
+        return
+    try:
+        return resp.json().get('errcode')
+    except ValueError:
         return
 
-    redis_client.set(key, jsapi_ticket, ex=int(expires_in) - 600)  # 提前10分钟更新jsapi_ticket
-    return jsapi_ticket
 
+def _call_api(wx, method, wx_url, params=None, **kwargs):
+    """
+    调用需要access_token的微信接口；access_token失效时刷新并重试一次
+    :param wx: [dict]
+    :param method:
+    :param wx_url:
+    :param params: [dict or None] 不包含access_token的URL参数
+    :param kwargs:
+    :return: [Response or None]
+    """
+    for retried in (False, True):
+        access_token = get_access_token(wx)
+        if not access_token:
+            return
 
-def get_card_api_ticket(wx):
+        resp = http_util.request(method, wx_url, params=dict(params or {}, access_token=access_token), verify=VERIFY,
+                                 **kwargs)
+        if retried or _errcode(resp) not in _INVALID_TOKEN_ERRCODES:
+            return resp
+
+        if not _invalidate_access_token(wx, access_token):
+            return resp
+
+
+def _post_json(wx, wx_url, data):
     """
-    获取微信卡券api_ticket
+    以JSON数据POST调用需要access_token的微信接口
+    :param wx: [dict]
+    :param wx_url:
+    :param data: [dict]
+    :return: [dict or None]
+    """
+    resp = _call_api(wx, 'POST', wx_url, data=json.dumps(data, ensure_ascii=False))
+    if resp is not None:
+        resp.encoding = 'utf-8'
+        return resp.json()
+
+
+def get_access_token(wx):
+    """
+    获取微信access_token
     :param wx: [dict]
     :return:
     """
-    app_id, app_secret = map(wx.get, ('app_id', 'app_secret'))
-    if not (app_id and app_secret):
-        return
+    return _get_credential(wx, 'access_token')
 
-    key = 'wx:%s:card_api_ticket' % app_id
-    card_api_ticket = redis_client.get(key)
-    if card_api_ticket:
-        return card_api_ticket
 
-    access_token = get_access_token(wx)
-    if not access_token:
-        return
+def get_jsapi_ticket(wx):
+    """
+    获取微信jsapi_ticket
+    :param wx: [dict]
+    :return:
+    """
+    return _get_credential(wx, 'jsapi_ticket')
 
-    wx_url = 'https://api.weixin.qq.com/cgi-bin/ticket/getticket'
-    params = {
-        'access_token': access_token,
-        'type': 'wx_card'
-    }
-    resp_json = requests.get(wx_url, params=params, verify=VERIFY).json()
-    card_api_ticket, expires_in = map(resp_json.get, ('ticket', 'expires_in'))
-    if not (card_api_ticket and expires_in):
-        return
 
-    redis_client.set(key, card_api_ticket, ex=int(expires_in) - 600)  # 提前10分钟更新card_api_ticket
-    return card_api_ticket
+def get_card_api_ticket(wx):
+    """
+    获取微信卡券api_ticket
+    :param wx: [dict]
+    :return:
+    """
+    return _get_credential(wx, 'card_api_ticket')
 
 
 def get_user_info(wx, openid):
@@ -117,23 +299,56 @@ def get_user_info(wx, openid):
     :param openid:
     :return:
     """
-    access_token = get_access_token(wx)
-    if not access_token:
-        return
-
     wx_url = 'https://api.weixin.qq.com/cgi-bin/user/info'
     params = {
-        'access_token': access_token,
         'openid': openid,
         'lang': 'zh_CN'
     }
-    resp = requests.get(wx_url, params=params, verify=VERIFY)
+    resp = _call_api(wx, 'GET', wx_url, params=params)
+    if resp is None:
+        return
+
     resp.encoding = 'utf-8'
     info = resp.json()
     if not info.get('errcode'):
         return info
 
 
+def get_user_info_batch(wx, openids):
+    """
+    批量获取微信用户基本信息（每次请求最多100个openid）
+    :param wx: [dict]
+    :param openids: [list]
+    :return: [list]
+    """
+    wx_url = 'https://api.weixin.qq.com/cgi-bin/user/info/batchget'
+    infos = []
+    for i in range(0, len(openids), 100):
+        data = {
+            'user_list': [{'openid': openid, 'lang': 'zh_CN'} for openid in openids[i:i + 100]]
+        }
+        resp_json = _post_json(wx, wx_url, data)
+        if resp_json and not resp_json.get('errcode'):
+            infos.extend(resp_json.get('user_info_list') or [])
+    return infos
+
+
+def get_followers(wx, next_openid=None):
+    """
+    获取微信公众号关注者openid列表（每次最多10000个）
+    :param wx: [dict]
+    :param next_openid: 从此openid之后开始拉取，为None时从头开始
+    :return:
+    """
+    wx_url = 'https://api.weixin.qq.com/cgi-bin/user/get'
+    params = {}
+    if next_openid:
+        params['next_openid'] = next_openid
+    resp = _call_api(wx, 'GET', wx_url, params=params)
+    if resp is not None:
+        return resp.json()
+
+
 def get_user_info_with_authorization(wx, code):
     """
     获取微信用户基本信息（网页授权）
@@ -153,7 +368,7 @@ def get_user_info_with_authorization(wx, code):
         'code': code,
         'grant_type': 'authorization_code'
     }
-    resp_json = requests.get(wx_url, params=params, verify=VERIFY).json()
+    resp_json = http_util.get(wx_url, params=params, verify=VERIFY).json()
     access_token, openid, refresh_token = map(resp_json.get, ('access_token', 'openid', 'refresh_token'))
     if not (access_token and openid):
         return
@@ -164,7 +379,7 @@ def get_user_info_with_authorization(wx, code):
     #     'access_token': access_token,
     #     'openid': openid
     # }
-    # resp_json = requests.get(wx_url, params=params, verify=VERIFY).json()
+    # resp_json = http_util.get(wx_url, params=params, verify=VERIFY).json()
     # if resp_json.get('errcode'):
     #     if not refresh_token:
     #         return
@@ -176,7 +391,7 @@ def get_user_info_with_authorization(wx, code):
     #         'grant_type': 'refresh_token',
     #         'refresh_token': refresh_token
     #     }
-    #     resp_json = requests.get(wx_url, params=params, verify=VERIFY).json()
+    #     resp_json = http_util.get(wx_url, params=params, verify=VERIFY).json()
     #     access_token, openid = map(resp_json.get, ('access_token', 'openid'))
     #     if not (access_token and openid):
     #         return
@@ -188,7 +403,7 @@ def get_user_info_with_authorization(wx, code):
         'openid': openid,
         'lang': 'zh_CN'
     }
-    resp = requests.get(wx_url, params=params, verify=VERIFY)
+    resp = http_util.get(wx_url, params=params, verify=VERIFY)
     resp.encoding = 'utf-8'
     info = resp.json()
     if not info.get('errcode'):
@@ -202,16 +417,14 @@ def get_temp_image_media(wx, media_id):
     :param media_id:
     :return:
     """
-    access_token = get_access_token(wx)
-    if not access_token:
-        return
-
     wx_url = 'https://api.weixin.qq.com/cgi-bin/media/get'
     params = {
-        'access_token': access_token,
         'media_id': media_id
     }
-    resp = requests.get(wx_url, params=params, verify=VERIFY)
+    resp = _call_api(wx, 'GET', wx_url, params=params)
+    if resp is None:
+        return
+
     content_type = resp.headers.get('Content-Type')
     if content_type and content_type.startswith('image/'):
         return resp.content
@@ -227,19 +440,16 @@ def upload_temp_media(wx, media_type, file_name, file_data, content_type):
     :param content_type:
     :return:
     """
-    access_token = get_access_token(wx)
-    if not access_token:
-        return
-
     wx_url = 'https://api.weixin.qq.com/cgi-bin/media/upload'
     params = {
-        'access_token': access_token,
         'type': media_type
     }
     files = {
         'media': (file_name, file_data, content_type)
     }
-    return requests.post(wx_url, params=params, files=files, verify=VERIFY).json().get('media_id')
+    resp = _call_api(wx, 'POST', wx_url, params=params, files=files)
+    if resp is not None:
+        return resp.json().get('media_id')
 
 
 def send_custom_message(wx, openid, msg_type, msg_data):
@@ -251,20 +461,13 @@ def send_custom_message(wx, openid, msg_type, msg_data):
     :param msg_data: [dict]
     :return:
     """
-    access_token = get_access_token(wx)
-    if not access_token:
-        return
-
     wx_url = 'https://api.weixin.qq.com/cgi-bin/message/custom/send'
-    params = {
-        'access_token': access_token
-    }
     data = {
         'touser': str(openid),
         'msgtype': str(msg_type),
         str(msg_type): msg_data
     }
-    return requests.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json()
+    return _post_json(wx, wx_url, data)
 
 
 def send_template_message(wx, openid, template_id, msg_data, url=None, miniprogram=None):
@@ -278,14 +481,7 @@ def send_template_message(wx, openid, template_id, msg_data, url=None, miniprogr
     :param miniprogram: [dict or None]
     :return:
     """
-    access_token = get_access_token(wx)
-    if not access_token:
-        return
-
     wx_url = 'https://api.weixin.qq.com/cgi-bin/message/template/send'
-    params = {
-        'access_token': access_token
-    }
     data = {
         'touser': str(openid),
         'template_id': str(template_id),
@@ -295,7 +491,7 @@ def send_template_message(wx, openid, template_id, msg_data, url=None, miniprogr
         data['url'] = str(url)
     if miniprogram:
         data['miniprogram'] = miniprogram
-    return requests.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json()
+    return _post_json(wx, wx_url, data)
 
 
 def create_menu(wx, buttons):
@@ -305,18 +501,11 @@ def create_menu(wx, buttons):
     :param buttons: [list]
     :return:
     """
-    access_token = get_access_token(wx)
-    if not access_token:
-        return
-
     wx_url = 'https://api.weixin.qq.com/cgi-bin/menu/create'
-    params = {
-        'access_token': access_token
-    }
     data = {
         'button': buttons
     }
-    return requests.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json()
+    return _post_json(wx, wx_url, data)
 
 
 def generate_qrcode_with_scene(wx, action, scene, expires=60):
@@ -329,14 +518,7 @@ def generate_qrcode_with_scene(wx, action, scene, expires=60):
     :param expires:
     :return:
     """
-    access_token = get_access_token(wx)
-    if not access_token:
-        return
-
     wx_url = 'https://api.weixin.qq.com/cgi-bin/qrcode/create'
-    params = {
-        'access_token': access_token
-    }
     data = {
         'action_name': str(action),
         'action_info': {
@@ -345,7 +527,10 @@ def generate_qrcode_with_scene(wx, action, scene, expires=60):
     }
     if not action.startswith('QR_LIMIT_'):
         data['expire_seconds'] = int(expires)
-    resp_json = requests.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json()
+    resp_json = _post_json(wx, wx_url, data)
+    if not resp_json:
+        return
+
     url, ticket = map(resp_json.get, ('url', 'ticket'))
     if not (url and ticket):
         return
@@ -354,7 +539,7 @@ def generate_qrcode_with_scene(wx, action, scene, expires=60):
     params = {
         'ticket': ticket
     }
-    resp = requests.get(wx_url, params=params, verify=VERIFY)
+    resp = http_util.get(wx_url, params=params, verify=VERIFY)
     content_type = resp.headers.get('Content-Type')
     if content_type and content_type.startswith('image/'):
         return url, resp.url, resp.content
@@ -410,14 +595,7 @@ def create_card(wx, card_type, base_info, advanced_info=None, gift=None, deal_de
     :param reduce_cost:
     :return:
     """
-    access_token = get_access_token(wx)
-    if not access_token:
-        return
-
     wx_url = 'https://api.weixin.qq.com/card/create'
-    params = {
-        'access_token': access_token
-    }
     card_info = {
         'base_info': base_info
     }
@@ -441,7 +619,9 @@ def create_card(wx, card_type, base_info, advanced_info=None, gift=None, deal_de
             str(card_type).lower(): card_info
         }
     }
-    return requests.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json().get('card_id')
+    resp_json = _post_json(wx, wx_url, data)
+    if resp_json:
+        return resp_json.get('card_id')
 
 
 def get_card(wx, card_id):
@@ -451,18 +631,13 @@ def get_card(wx, card_id):
     :param card_id:
     :return:
     """
-    access_token = get_access_token(wx)
-    if not access_token:
-        return
-
     wx_url = 'https://api.weixin.qq.com/card/get'
-    params = {
-        'access_token': access_token
-    }
     data = {
         'card_id': str(card_id)
     }
-    return requests.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json().get('card')
+    resp_json = _post_json(wx, wx_url, data)
+    if resp_json:
+        return resp_json.get('card')
 
 
 def modify_card_stock(wx, card_id, increase_stock_value):
@@ -473,14 +648,7 @@ def modify_card_stock(wx, card_id, increase_stock_value):
     :param increase_stock_value:
     :return:
     """
-    access_token = get_access_token(wx)
-    if not access_token:
-        return
-
     wx_url = 'https://api.weixin.qq.com/card/modifystock'
-    params = {
-        'access_token': access_token
-    }
     data = {
         'card_id': str(card_id)
     }
@@ -488,7 +656,7 @@ def modify_card_stock(wx, card_id, increase_stock_value):
         data['increase_stock_value'] = increase_stock_value
     else:
         data['reduce_stock_value'] = -increase_stock_value
-    return requests.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json()
+    return _post_json(wx, wx_url, data)
 
 
 def delete_card(wx, card_id):
@@ -498,18 +666,11 @@ def delete_card(wx, card_id):
     :param card_id:
     :return:
     """
-    access_token = get_access_token(wx)
-    if not access_token:
-        return
-
     wx_url = 'https://api.weixin.qq.com/card/delete'
-    params = {
-        'access_token': access_token
-    }
     data = {
         'card_id': str(card_id)
     }
-    return requests.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json()
+    return _post_json(wx, wx_url, data)
 
 
 def decrypt_card_code(wx, encrypt_code):
@@ -519,18 +680,13 @@ def decrypt_card_code(wx, encrypt_code):
     :param encrypt_code:
     :return:
     """
-    access_token = get_access_token(wx)
-    if not access_token:
-        return
-
     wx_url = 'https://api.weixin.qq.com/card/code/decrypt'
-    params = {
-        'access_token': access_token
-    }
     data = {
         'encrypt_code': str(encrypt_code)
     }
-    return requests.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json().get('code')
+    resp_json = _post_json(wx, wx_url, data)
+    if resp_json:
+        return resp_json.get('code')
 
 
 def get_card_code(wx, code, card_id=None, check_consume=False):
@@ -542,21 +698,14 @@ def get_card_code(wx, code, card_id=None, check_consume=False):
     :param check_consume: [bool]
     :return:
     """
-    access_token = get_access_token(wx)
-    if not access_token:
-        return
-
     wx_url = 'https://api.weixin.qq.com/card/code/get'
-    params = {
-        'access_token': access_token
-    }
     data = {
         'code': str(code),
         'check_consume': check_consume
     }
     if card_id:
         data['card_id'] = str(card_id)
-    return requests.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json()
+    return _post_json(wx, wx_url, data)
 
 
 def consume_card_code(wx, code, card_id=None):
@@ -567,20 +716,13 @@ def consume_card_code(wx, code, card_id=None):
     :param card_id:
     :return:
     """
-    access_token = get_access_token(wx)
-    if not access_token:
-        return
-
     wx_url = 'https://api.weixin.qq.com/card/code/consume'
-    params = {
-        'access_token': access_token
-    }
     data = {
         'code': str(code)
     }
     if card_id:
         data['card_id'] = str(card_id)
-    return requests.post(wx_url, params=params, data=json.dumps(data, ensure_ascii=False), verify=VERIFY).json()
+    return _post_json(wx, wx_url, data)
 
 
 def generate_card_sign(wx, data):